@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Per-port latency of the dlink.so receive path as the number of ports grows.
+#
+# For every port count a network namespace gets that many veth ports, a child
+# process opens them with wrapper.init and echoes every frame back on the port
+# it came from, and this process sends probes on the ports in turn, one at a
+# time, and measures the round trip of each one. With --hog port 0 is flooded
+# during the run, so an unfair receive loop shows up as the other ports
+# waiting behind it.
+#
+# Usage (as root, from the repository root, after make):
+#   python3 checker/bench.py [--counts 2 4 8 16 32 64] [--rounds 200]
+#                            [--batch N] [--hog]
+import argparse
+import os
+import select
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+NETNS = "dlink-bench"
+PACKET_OUTGOING = 4
+PROBE_TYPE = 0x88B5  # local experimental ethertype
+
+
+def sh(cmd):
+    subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def setup(count):
+    teardown(count)
+    sh(f"ip netns add {NETNS}")
+    for i in range(count):
+        sh(f"ip link add bh{i} type veth peer name bp{i} netns {NETNS}")
+        sh(f"sysctl -qw net.ipv6.conf.bh{i}.disable_ipv6=1")
+        sh(f"ip link set bh{i} up")
+        sh(f"ip netns exec {NETNS} ip link set bp{i} up")
+
+
+def teardown(count):
+    subprocess.run(f"ip netns del {NETNS}", shell=True,
+                   stderr=subprocess.DEVNULL)
+    for i in range(count):
+        subprocess.run(f"ip link del bh{i}", shell=True,
+                       stderr=subprocess.DEVNULL)
+
+
+def echo(batch, names):
+    # runs inside the namespace, every frame goes back where it came from
+    import wrapper
+
+    wrapper.init(names)
+    while True:
+        if batch:
+            frames = wrapper.recv_batch(batch)
+        else:
+            frames = [wrapper.recv_from_any_link()]
+
+        for port, buf, length in frames:
+            if port < 0:
+                continue
+            start = wrapper.HEADROOM
+            wrapper.send_to_link(port, length, buf[start:start + length])
+
+
+def hog(sock, stop):
+    # keeps port 0 busy with frames nobody waits for
+    frame = b"\xff" * 6 + b"\x02" + b"\x00" * 5 + b"\x00\x00" + b"\x00" * 46
+    while not stop.is_set():
+        try:
+            sock.send(frame)
+        except OSError:
+            time.sleep(0.0001)
+
+
+def measure(count, rounds, batch, with_hog):
+    setup(count)
+    names = [f"bp{i}" for i in range(count)]
+    child = subprocess.Popen(["ip", "netns", "exec", NETNS, sys.executable,
+                              __file__, "--echo", str(batch)] + names,
+                             stdout=subprocess.DEVNULL)
+
+    socks = []
+    for i in range(count):
+        s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                          socket.htons(PROBE_TYPE))
+        s.bind((f"bh{i}", 0))
+        s.setblocking(False)
+        socks.append(s)
+
+    stop = threading.Event()
+    if with_hog:
+        hog_sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        hog_sock.bind(("bh0", 0))
+        threading.Thread(target=hog, args=(hog_sock, stop),
+                         daemon=True).start()
+
+    time.sleep(0.5)
+    rtts = [[] for _ in range(count)]
+
+    for r in range(rounds):
+        for i, s in enumerate(socks):
+            # the hogged port is not measured
+            if with_hog and i == 0:
+                continue
+
+            payload = struct.pack("!IId", r, i, time.perf_counter())
+            src = bytes([0x02, 0, 0, 0, i >> 8, i & 0xFF])
+            s.send(b"\xff" * 6 + src + struct.pack("!H", PROBE_TYPE) +
+                   payload.ljust(46, b"\0"))
+
+            deadline = time.perf_counter() + 0.5
+            while time.perf_counter() < deadline:
+                if not select.select([s], [], [], 0.1)[0]:
+                    continue
+                try:
+                    data, addr = s.recvfrom(2048)
+                except BlockingIOError:
+                    continue
+                if addr[2] == PACKET_OUTGOING:
+                    continue
+                seq, port, sent = struct.unpack_from("!IId", data, 14)
+                if seq == r and port == i:
+                    rtts[port].append(time.perf_counter() - sent)
+                    break
+
+    stop.set()
+    child.kill()
+    child.wait()
+    for s in socks:
+        s.close()
+    teardown(count)
+
+    return [sorted(x) for x in rtts if x]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+",
+                        default=[2, 4, 8, 16, 32, 64])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--hog", action="store_true",
+                        help="flood port 0 and measure the others")
+    parser.add_argument("--echo", type=int, default=None,
+                        help=argparse.SUPPRESS)
+    args, names = parser.parse_known_args()
+
+    if args.echo is not None:
+        echo(args.echo, names)
+        return
+
+    mode = f"recv_batch({args.batch})" if args.batch else "recv_from_any_link"
+    print(f"{mode}{', port 0 hogged' if args.hog else ''}: "
+          f"round trip per port in microseconds")
+    print(f"{'ports':>5}  {'median':>8}  {'p99':>8}  {'worst port median':>17}"
+          f"  {'lost':>5}")
+
+    for count in args.counts:
+        rtts = measure(count, args.rounds, args.batch, args.hog)
+        every = sorted(x for port in rtts for x in port)
+        if not every:
+            print(f"{count:>5}  no replies")
+            continue
+        medians = [statistics.median(port) for port in rtts]
+        expected = (count - (1 if args.hog else 0)) * args.rounds
+        print(f"{count:>5}  {statistics.median(every) * 1e6:>8.1f}  "
+              f"{every[int(len(every) * 0.99) - 1] * 1e6:>8.1f}  "
+              f"{max(medians) * 1e6:>17.1f}  {expected - len(every):>5}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    main()
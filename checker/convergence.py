@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Spanning tree failover time on the checker topology.
+#
+# Builds the topology of checker/topo.py (3 switches in a triangle, 2 hosts
+# each) with network namespaces, starts switch.py with the configs in
+# configs/ and, once it converged, sends a broadcast probe every --interval
+# seconds from a host of one switch to a host of the same vlan on another
+# one. After a second, one end of a trunk is set down (by default the link
+# between the root bridge and the switch with the worst priority, whose root
+# port it is). The outage is the longest time without a probe arriving; probes
+# arriving more than once mean the tree had a loop. With --unicast the probes
+# go to the mac of the receiving host, which first sends a frame so that the
+# switches learn it: they only arrive after the cut if the switches flushed
+# the entries behind the link that went down.
+#
+# Usage (as root, from the repository root, after make):
+#   python3 checker/convergence.py [--settle 8] [--cut rr-1-2]
+#                                  [--interval 0.005] [--duration 6]
+#                                  [--unicast]
+import argparse
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import info
+
+PROBE_TYPE = 0x88B5  # local experimental ethertype
+
+
+def sh(cmd):
+    subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def read_config(i):
+    with open(f"configs/switch{i}.cfg") as fin:
+        lines = fin.read().split("\n")
+
+    vlans = {}
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) == 2 and fields[0].startswith("r-"):
+            vlans[int(fields[0][2:])] = fields[1]
+
+    return int(lines[0]), vlans
+
+
+def ns(i):
+    return info.get("switch_name", i)
+
+
+def setup():
+    teardown()
+    for i in range(info.N_ROUTERS):
+        sh(f"ip netns add {ns(i)}")
+        sh(f"ip netns exec {ns(i)} sysctl -qw "
+           "net.ipv6.conf.all.disable_ipv6=1 "
+           "net.ipv6.conf.default.disable_ipv6=1")
+
+    # switch.py numbers the interfaces by ifindex - 2: the trunks come first,
+    # then the host ports, like in the mininet topology
+    index = [2] * info.N_ROUTERS
+    for i in range(info.N_ROUTERS):
+        for j in range(i + 1, info.N_ROUTERS):
+            name = info.get("r2r_if_name", i, j)
+            sh(f"ip netns exec {ns(i)} ip link add {name} index {index[i]} "
+               f"type veth peer name {name} index {index[j]} netns {ns(j)}")
+            index[i] += 1
+            index[j] += 1
+
+    for i in range(info.N_ROUTERS):
+        for j in range(info.N_HOSTSEACH):
+            h = i * info.N_HOSTSEACH + j
+            host = info.get("host_if_name", h)
+            sh(f"ip netns exec {ns(i)} ip link add "
+               f"{info.get('router_if_name', j)} index {index[i]} "
+               f"type veth peer name {host} netns 1")
+            index[i] += 1
+            sh(f"sysctl -qw net.ipv6.conf.{host}.disable_ipv6=1")
+            sh(f"ip link set {host} up")
+
+        sh(f"ip netns exec {ns(i)} sh -c 'for l in "
+           f"$(ls /sys/class/net | grep -v lo); do ip link set $l up; done'")
+
+
+def teardown():
+    for i in range(info.N_ROUTERS):
+        subprocess.run(f"ip netns pids {ns(i)} 2>/dev/null | xargs -r kill",
+                       shell=True)
+        subprocess.run(f"ip netns del {ns(i)}", shell=True,
+                       stderr=subprocess.DEVNULL)
+    for h in range(info.N_ROUTERS * info.N_HOSTSEACH):
+        subprocess.run(f"ip link del {info.get('host_if_name', h)}",
+                       shell=True, stderr=subprocess.DEVNULL)
+
+
+def start_switches():
+    procs = []
+    for i in range(info.N_ROUTERS):
+        # ip link lists the interfaces in ifindex order
+        links = subprocess.run(f"ip netns exec {ns(i)} ip -o link", shell=True,
+                               capture_output=True, text=True).stdout
+        names = [line.split(": ")[1].split("@")[0]
+                 for line in links.splitlines()]
+        names = [name for name in names if name != "lo"]
+        procs.append(subprocess.Popen(
+            ["ip", "netns", "exec", ns(i), sys.executable, "switch.py",
+             str(i)] + names, stdout=subprocess.DEVNULL))
+
+    return procs
+
+
+def pick(configs, cut):
+    # the link to cut and two hosts of the same vlan on its two sides
+    priorities = [priority for priority, _ in configs]
+    root = priorities.index(min(priorities))
+    if cut is None:
+        worst = priorities.index(max(priorities))
+        cut = info.get("r2r_if_name", min(root, worst), max(root, worst))
+
+    a, b = (int(x) for x in cut.split("-")[1:])
+    down = b if a == root else a
+    up = root if root in (a, b) else b
+
+    for j, vlan in configs[down][1].items():
+        for k, other in configs[up][1].items():
+            if vlan == other:
+                return cut, down, down * info.N_HOSTSEACH + j, \
+                    up * info.N_HOSTSEACH + k
+
+    sys.exit(f"no vlan with hosts on both switch {down} and {up}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--settle", type=float, default=8)
+    parser.add_argument("--cut", default=None,
+                        help="trunk to set down, e.g. rr-1-2")
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument("--duration", type=float, default=6)
+    parser.add_argument("--unicast", action="store_true",
+                        help="send the probes to the learned receiver mac")
+    args = parser.parse_args()
+
+    configs = [read_config(i) for i in range(info.N_ROUTERS)]
+    cut, down, src, dst = pick(configs, args.cut)
+
+    setup()
+    try:
+        start_switches()
+        time.sleep(args.settle)
+
+        tx = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        tx.bind((info.get("host_if_name", src), 0))
+        rx = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                           socket.htons(PROBE_TYPE))
+        rx.bind((info.get("host_if_name", dst), 0))
+        rx.setblocking(False)
+
+        src_mac = bytes.fromhex(
+            info.get("host_mac", src).replace(":", ""))
+        dst_mac = b"\xff" * 6
+        if args.unicast:
+            dst_mac = bytes.fromhex(
+                info.get("host_mac", dst).replace(":", ""))
+            rx.send(b"\xff" * 6 + dst_mac +
+                    struct.pack("!H", PROBE_TYPE).ljust(48, b"\0"))
+            time.sleep(0.1)
+        arrivals = {}
+        start = time.perf_counter()
+        next_send = start
+        seq = 0
+        cut_at = None
+
+        while time.perf_counter() - start < args.duration:
+            now = time.perf_counter()
+            if cut_at is None and now - start >= 1:
+                sh(f"ip netns exec {ns(down)} ip link set {cut} down")
+                cut_at = time.perf_counter()
+
+            if now >= next_send:
+                tx.send(dst_mac + src_mac +
+                        struct.pack("!HI", PROBE_TYPE, seq).ljust(48, b"\0"))
+                seq += 1
+                next_send += args.interval
+
+            if select.select([rx], [], [], max(0, next_send - now))[0]:
+                while True:
+                    try:
+                        data = rx.recv(2048)
+                    except BlockingIOError:
+                        break
+                    if data[6:12] != src_mac:
+                        continue
+                    n = struct.unpack_from("!I", data, 14)[0]
+                    arrivals.setdefault(n, []).append(time.perf_counter())
+
+        got = sorted(arrivals)
+        times = [arrivals[n][0] for n in got]
+        gaps = [b - a for a, b in zip(times, times[1:]) if b > cut_at]
+        outage = max(gaps) if gaps else float("inf")
+        duplicates = sum(len(t) - 1 for t in arrivals.values())
+
+        print(f"cut {cut} on switch {down}, probes from host {src} to "
+              f"host {dst} every {args.interval * 1000:.0f} ms")
+        print(f"sent {seq}, received {len(got)}, lost {seq - len(got)}, "
+              f"duplicated {duplicates}")
+        print(f"outage {outage * 1000:.0f} ms")
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Regression checks of the evictions of the FDB of switch.py: a full table
+# (or vlan) makes room with its oldest entry, which may be the last one of the
+# vlan of the new mac. The table must stay consistent then, learning the
+# same macs again, aging and flushing them must not fail.
+#
+# Usage (from the repository root, after make):
+#   python3 checker/fdb_eviction.py
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())
+from switch import CONFIG_OPTIONS, FDB  # noqa: E402
+
+
+def mac(n):
+    return n.to_bytes(6, 'big')
+
+
+def fdb(**limits):
+    options = dict(CONFIG_OPTIONS)
+    options.update(limits)
+    return FDB(options)
+
+
+def consistent(table):
+    # every entry is in the stamps and in the dict of its vlan, and only them
+    vlan_keys = [key for keys in table.vlans.values() for key in keys]
+    return set(table.entries) == set(table.stamps) == set(vlan_keys) and \
+        len(vlan_keys) == len(table.entries) and all(table.vlans.values())
+
+
+def global_eviction():
+    # the global eviction removes the only entry of the vlan of the new mac
+    table = fdb(**{'fdb-max': 2})
+    table.learn(1, mac(0xa), 1, 0)
+    table.learn(2, mac(0xb), 2, 0)
+    table.learn(1, mac(0xc), 3, 1)
+    table.learn(1, mac(0xc), 3, 2)
+    ok = consistent(table) and table.lookup(1, mac(0xc)) == 3
+    table.age(2 + table.aging)
+    return ok and consistent(table) and len(table) == 0
+
+
+def vlan_eviction():
+    # with one entry per vlan, every new mac evicts the previous one
+    table = fdb(**{'fdb-max-vlan': 1})
+    for n in range(4):
+        table.learn(1, mac(n), n, n)
+        table.learn(1, mac(n), n, n + 1)
+    ok = consistent(table) and len(table) == 1 and \
+        table.lookup(1, mac(3)) == 3
+    table.flush((3,))
+    return ok and consistent(table) and len(table) == 0
+
+
+def main():
+    failed = 0
+    for check in (global_eviction, vlan_eviction):
+        passed = check()
+        failed += not passed
+        print(f"{'PASS' if passed else 'FAIL'} {check.__name__}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Stress check of the shared FDB of the multi-process mode (lib/fdb.c): a few
+# worker processes keep learning a moving window of macs while this process,
+# like the control one, keeps expiring them, so that slots are removed and
+# freed under the learners all the time. Only this process removes entries,
+# so between its passes no mac may be in the table twice and every entry
+# must be found by a lookup: a probe sequence cut under a learner loses it.
+#
+# Usage (from the repository root, after make):
+#   python3 checker/fdb_stress.py [seconds] [workers]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+from wrapper import fdb_create, fdb_learn, fdb_lookup, fdb_expire, \
+                    fdb_count, fdb_entries  # noqa: E402
+
+# A small table, so the probe sequences run into each other
+MAX_ENTRIES = 128
+WINDOW = 24
+STEP = 4
+AGING = 8
+VLAN = 1 << 48
+
+
+def tick(start):
+    # the clock of the table, in milliseconds
+    return int((time.monotonic() - start) * 1000)
+
+
+def learner(start, seconds, seed):
+    # learns the macs of a window that moves every tick, from the same port
+    # as the other workers, so a mac is never moved
+    n = seed
+    while time.monotonic() - start < seconds:
+        now = tick(start)
+        key = VLAN | (now * STEP + n % WINDOW)
+        fdb_learn(key, key % 8, now)
+        n += 7
+    os._exit(0)
+
+
+def check(now):
+    # Returns: the macs in the table twice and the entries not found
+    keys = [key for key, _, _, _ in fdb_entries(now)]
+    lost = [key for key in keys if fdb_lookup(key) == -1]
+    return len(keys) - len(set(keys)), len(lost), len(keys)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    fdb_create(MAX_ENTRIES, MAX_ENTRIES, 1 << 30, 1, 1)
+    start = time.monotonic()
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            learner(start, seconds, worker)
+        pids.append(pid)
+
+    expired = passes = duplicates = lost = 0
+    while time.monotonic() - start < seconds:
+        expired += fdb_expire(tick(start), AGING)
+        twice, missing, _ = check(tick(start))
+        duplicates += twice
+        lost += missing
+        passes += 1
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    print(f"{passes} passes expired {expired} entries, {duplicates} twice "
+          f"in the table, {lost} not found")
+    passed = expired > 0 and not duplicates and not lost and \
+        fdb_count() == check(tick(start))[2]
+    print(f"{'PASS' if passed else 'FAIL'} learn while expiring")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
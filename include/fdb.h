@@ -0,0 +1,81 @@
+#ifndef _FDB_H_
+#define _FDB_H_
+
+#include <stdint.h>
+
+/*
+ * Forwarding database of the multi-process mode. A hash table (open
+ * addressing, linear probing) in an anonymous shared mapping, created before
+ * the workers are forked, so they all learn into and look up in the same
+ * table. Lookups and refreshes take no lock, a new mac is added (and a
+ * removed slot freed) under a spin lock in the table. The key is
+ * vlan << 48 | mac, like the FDB of switch.py, with the same aging, size
+ * limits and flap detection, except that a full table (or vlan) does not
+ * learn new macs until entries age out.
+ */
+
+/* marks a slot in use, the vlan takes bits 48-59 of a key */
+#define FDB_USED (1ULL << 63)
+/* a removed entry, lookups go past it */
+#define FDB_DELETED (~0ULL)
+
+#define FDB_MAX_VLANS 4096
+
+struct fdb_slot {
+	uint64_t key;		/* FDB_USED | key, 0 if never used or FDB_DELETED */
+	int32_t port;		/* -1 while the entry is being written */
+	uint32_t stamp;		/* second it was last seen in */
+	uint32_t move_start;	/* start of the flap counting window */
+	uint32_t moves;		/* port changes in the window */
+	uint32_t frozen;	/* second until which the port is kept, 0 if not */
+	uint32_t unused;
+};
+
+struct fdb_table {
+	uint32_t mask;		/* number of slots - 1, a power of two - 1 */
+	uint32_t max_entries;
+	uint32_t max_vlan_entries;
+	uint32_t flap_moves;
+	uint32_t flap_window;
+	uint32_t flap_hold;
+	uint32_t count;
+	uint32_t lock;		/* held to add an entry or free a removed slot */
+	uint32_t vlan_count[FDB_MAX_VLANS];
+	struct fdb_slot slots[];
+};
+
+/*
+ * @brief Maps the shared table, sized for max_entries. Must be called before
+ * fork() for the table to be shared.
+ */
+void fdb_create(unsigned int max_entries, unsigned int max_vlan_entries,
+		unsigned int flap_moves, unsigned int flap_window,
+		unsigned int flap_hold);
+
+/* Learns (or refreshes) that key was seen on port at second now */
+void fdb_learn(uint64_t key, int port, unsigned int now);
+
+/* Returns: the port of key, -1 if it is not known */
+int fdb_lookup(uint64_t key);
+
+/* Removes the entries not seen for aging seconds. Returns: how many */
+int fdb_expire(unsigned int now, unsigned int aging);
+
+/*
+ * @brief Removes the entries on one of the count ports, only in vlan if it
+ * is not -1. Returns: how many
+ */
+int fdb_flush(const int *ports, int count, int vlan);
+
+/* Returns: the number of entries */
+int fdb_count(void);
+
+/*
+ * @brief Copies up to max entries out of the table, for diagnostics.
+ * Returns: the number of entries copied. frozen[i] is 1 if the port of
+ * entry i is frozen at second now.
+ */
+int fdb_entries(uint64_t *keys, int *ports, unsigned int *stamps, int *frozen,
+		int max, unsigned int now);
+
+#endif /* _FDB_H_ */
@@ -7,27 +7,100 @@
 #include <stdlib.h>
 
 #define MAX_PACKET_LEN 1600
-#define SWITCH_NUM_INTERFACES 4
+#define MAX_BATCH 64
+
+/* I/O modes of init_mode */
+#define IO_SOCKET 0
+#define IO_RING 1
 
 int send_to_link(int interface, char *frame_data, size_t length);
 
+/* Length of a vlan tag, inserted after the macs of a frame */
+#define VLAN_TAG_LEN 4
+
+/*
+ * @brief Sends a frame on many interfaces in a single call, e.g. a flood:
+ * untagged to the nuntagged interfaces in untagged and with the vlan tag to
+ * the ntagged ones in tagged. frame_data is the frame as received, is_tagged
+ * says whether it already holds the tag; the other representation is
+ * gathered from it (and from tag, the VLAN_TAG_LEN bytes to add) with
+ * scatter writes, the frame is never rewritten.
+ * Returns: the number of frames sent.
+ */
+int send_to_many(int *untagged, int nuntagged, int *tagged, int ntagged,
+		 char *frame_data, size_t len, int is_tagged, char *tag);
+
 /*
  * @brief Receives a packet. Blocking function, blocks if there is no packet to
- * be received.
+ * be received. The ready interfaces are served in turns, one packet each.
  *
  * @param frame_data - region of memory in which the data will be copied; should
  *        have at least MAX_PACKET_LEN bytes allocated 
  * @param length - will be set to the total number of bytes received.
- * Returns: the interface it has been received from.
+ * Returns: the interface it has been received from, -1 if interrupted by a
+ * signal.
  */
 int recv_from_any_link(char *frame_data, size_t *length);
 
+/*
+ * @brief Receives up to max_frames packets from all the ready interfaces in a
+ * single call. Blocks until at least one packet is available. Each ready
+ * interface may take at most an equal share of the batch.
+ *
+ * @param frames - where the first packet is copied, packet i is copied at
+ *        frames + i * stride; each one should have MAX_PACKET_LEN bytes
+ * @param stride - distance between two packets, at least MAX_PACKET_LEN, it
+ *        leaves room for a headroom in front of each packet
+ * @param ports - will be set to the interface of each packet
+ * @param lengths - will be set to the length of each packet
+ * @param max_frames - capped at MAX_BATCH
+ * Returns: the number of packets received, 0 if interrupted by a signal.
+ */
+int recv_batch(char *frames, size_t stride, int *ports, size_t *lengths,
+	       int max_frames);
+
+/*
+ * @brief Receives up to max_frames packets of a single interface, without
+ * blocking, e.g. when an event loop reports its socket readable. Same frame
+ * layout as recv_batch.
+ * Returns: the number of packets received, 0 if there are none.
+ */
+int recv_link_batch(int interface, char *frames, size_t stride,
+		    size_t *lengths, int max_frames);
 
-/* Returns the name of an itnerface */
+/* Returns: the file descriptor an interface receives on, to be polled by an
+ * event loop */
+int get_interface_fd(int interface);
+
+/* Returns the name of an itnerface. The result points to a static buffer
+ * that is overwritten by the next call */
 char *get_interface_name(int interface);
 
 char *get_interface_ip(int interface);
 
+/* Returns: 1 if the interface is up and has carrier, 0 otherwise */
+int link_up(int interface);
+
+/*
+ * @brief Sets the interface administratively up or down (IFF_UP), the peer
+ * of a link that goes down loses its carrier. Returns: 0, -1 on error
+ */
+int set_link_up(int interface, int up);
+
+/*
+ * @brief Opens a netlink socket that gets the link changes (carrier, up and
+ * down) of the interfaces, so that they are noticed without polling link_up.
+ * Returns: its file descriptor, to be polled, -1 if it can not be opened
+ */
+int link_events_open(void);
+
+/* Reads all the pending link changes of the link_events_open socket.
+ * Returns: how many concern the interfaces of the switch */
+int read_link_events(void);
+
+/* Returns: the speed of the interface in Mb/s (ethtool), -1 if unknown */
+int link_speed(int interface);
+
 /**
  * @brief Get the interface mac object. The function writes
  * the MAC at the pointer mac. uint8_t *mac should be allocated.
@@ -45,8 +118,28 @@ void get_interface_mac(int interface, uint8_t *mac);
  */
 int hwaddr_aton(const char *txt, uint8_t *addr);
 
+/* Opens a socket for each of the argc interfaces, any number of them.
+ * Returns: the number of interfaces */
 int init(int argc, char *argv[]);
 
+/*
+ * @brief Same as init, with mode IO_RING the interfaces use PACKET_MMAP rings
+ * (see ring.h) instead of plain read/write sockets. If the rings can not be
+ * set up, it falls back to IO_SOCKET.
+ */
+int init_mode(int argc, char *argv[], int mode);
+
+/* Returns: the I/O mode actually in use, IO_SOCKET or IO_RING */
+int get_io_mode(void);
+
+/*
+ * @brief Called in a worker process forked after init (IO_SOCKET only): the
+ * receive calls of this process only wait on the count interfaces in
+ * rx_interfaces. Frames can still be sent on any interface. The worker gets
+ * SIGTERM when its parent exits.
+ */
+void init_worker(int *rx_interfaces, int count);
+
 #define DIE(condition, message, ...) \
 	do { \
 		if ((condition)) { \
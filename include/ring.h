@@ -0,0 +1,80 @@
+#ifndef _RING_H_
+#define _RING_H_
+
+#include <stddef.h>
+#include <sys/uio.h>
+
+/*
+ * PACKET_MMAP I/O. Every interface gets a TPACKET_V3 RX ring (frames are
+ * handed over a whole block at a time) and, on a second socket, a TPACKET_V2
+ * TX ring. Frames are read and written straight in the shared memory, the
+ * only syscalls are the epoll_wait when no block is ready and one send() per
+ * interface to flush its queued TX frames.
+ */
+
+/* Free bytes the kernel leaves in front of every received frame, so a vlan
+ * tag can be inserted in place. Must match HEADROOM in wrapper.py */
+#define RING_HEADROOM 4
+
+#define RX_BLOCK_SIZE (1 << 16)
+#define RX_BLOCK_NR 16
+#define RX_FRAME_SIZE 2048
+/* ms after which a block that is not full is still handed over */
+#define RX_BLOCK_TIMEOUT 1
+
+#define TX_BLOCK_SIZE (1 << 16)
+#define TX_BLOCK_NR 2
+#define TX_FRAME_SIZE 2048
+#define TX_FRAME_NR (TX_BLOCK_SIZE / TX_FRAME_SIZE * TX_BLOCK_NR)
+
+extern int *interfaces;
+extern int num_interfaces;
+extern int epoll_fd;
+
+/*
+ * @brief Replaces the sockets of the interfaces with ring ones. Leaves the
+ * plain sockets in place if the rings can not be set up.
+ * Returns: 0 on success, -1 otherwise.
+ */
+int ring_setup(char *argv[]);
+
+/* Returns: 1 if the rings are in use */
+int ring_enabled(void);
+
+/*
+ * @brief Waits for the next block of received frames, the interfaces are
+ * checked in turns. The block stays owned by the caller until
+ * ring_release_block.
+ *
+ * @param offset - will be set to the offset of the block in the RX ring of
+ *        the interface (see ring_rx_map)
+ * Returns: the interface of the block, -1 if interrupted by a signal.
+ */
+int ring_next_block(size_t *offset);
+
+/* Gives the current block of the interface back to the kernel */
+void ring_release_block(int interface);
+
+/* Returns the RX ring of the interface, size is set to its length */
+char *ring_rx_map(int interface, size_t *size);
+
+/* Copies a frame in the TX ring of the interface and, unless the calling
+ * thread defers its sends, flushes it. Returns: len, -1 if dropped */
+int ring_send(int interface, char *frame_data, size_t len);
+
+/* Queues a frame in the TX ring of the interface without flushing it */
+int ring_queue(int interface, char *frame_data, size_t len);
+
+/* The same, for a frame made of iovcnt pieces */
+int ring_queue_iov(int interface, const struct iovec *iov, int iovcnt);
+
+/* Flushes the queued frames of an interface, unless the thread defers */
+void ring_kick(int interface);
+
+/* While on, the sends of the calling thread are only queued */
+void ring_defer_tx(int on);
+
+/* Flushes the queued frames of all the interfaces */
+void ring_flush(void);
+
+#endif /* _RING_H_ */
@@ -0,0 +1,311 @@
+#include "lib.h"
+#include "fdb.h"
+
+#include <sched.h>
+#include <sys/mman.h>
+
+static struct fdb_table *fdb;
+
+#define LOAD(p) __atomic_load_n((p), __ATOMIC_ACQUIRE)
+#define STORE(p, v) __atomic_store_n((p), (v), __ATOMIC_RELEASE)
+
+static size_t table_size(uint32_t slots)
+{
+	return sizeof(struct fdb_table) + slots * sizeof(struct fdb_slot);
+}
+
+void fdb_create(unsigned int max_entries, unsigned int max_vlan_entries,
+		unsigned int flap_moves, unsigned int flap_window,
+		unsigned int flap_hold)
+{
+	uint32_t slots = 16;
+
+	/* at most half full, so the probe sequences stay short */
+	while (slots < 2 * max_entries)
+		slots <<= 1;
+
+	fdb = mmap(NULL, table_size(slots), PROT_READ | PROT_WRITE,
+		   MAP_SHARED | MAP_ANONYMOUS, -1, 0);
+	DIE(fdb == MAP_FAILED, "mmap");
+
+	fdb->mask = slots - 1;
+	fdb->max_entries = max_entries;
+	fdb->max_vlan_entries = max_vlan_entries;
+	fdb->flap_moves = flap_moves;
+	fdb->flap_window = flap_window;
+	fdb->flap_hold = flap_hold;
+	for (uint32_t i = 0; i < slots; i++)
+		fdb->slots[i].port = -1;
+}
+
+static uint32_t fdb_hash(uint64_t key)
+{
+	return (key * 0x9E3779B97F4A7C15ULL) >> 32;
+}
+
+static void print_mac(uint64_t key)
+{
+	for (int i = 5; i >= 0; i--)
+		printf("%02x%s", (unsigned int)(key >> (8 * i)) & 0xFF,
+		       i ? ":" : "");
+}
+
+/*
+ * The move counters of an entry are updated without a lock, two workers
+ * moving the same mac at the same time may lose a count. A flapping mac
+ * moves many times, so it is frozen anyway
+ */
+static void fdb_move(struct fdb_slot *s, uint64_t key, int port,
+		     unsigned int now)
+{
+	uint32_t frozen = LOAD(&s->frozen);
+
+	if (frozen)
+	{
+		if (now < frozen)
+			return;
+		STORE(&s->frozen, 0);
+	}
+
+	if (now - s->move_start >= fdb->flap_window)
+	{
+		s->move_start = now;
+		s->moves = 0;
+	}
+
+	if (++s->moves > fdb->flap_moves)
+	{
+		s->moves = 0;
+		STORE(&s->frozen, now + fdb->flap_hold);
+		printf("FDB: ");
+		print_mac(key);
+		printf(" in vlan %u is flapping between ports %d and %d, "
+		       "frozen for %us\n", (unsigned int)(key >> 48) & 0xFFF,
+		       s->port, port, fdb->flap_hold);
+		fflush(stdout);
+		return;
+	}
+
+	STORE(&s->port, port);
+}
+
+/*
+ * The slot of key, NULL if it is not in the table. free_slot gets the first
+ * slot the key could be added in, NULL if there is none
+ */
+static struct fdb_slot *fdb_find(uint64_t key, struct fdb_slot **free_slot)
+{
+	uint64_t used = FDB_USED | key;
+	uint32_t i = fdb_hash(key) & fdb->mask;
+
+	*free_slot = NULL;
+	for (uint32_t probe = 0; probe <= fdb->mask; probe++)
+	{
+		struct fdb_slot *s = &fdb->slots[(i + probe) & fdb->mask];
+		uint64_t k = LOAD(&s->key);
+
+		if (k == used)
+			return s;
+
+		if (k == FDB_DELETED && *free_slot == NULL)
+			*free_slot = s;
+
+		/* the end of the probe sequence, the key is not in the table */
+		if (k == 0)
+		{
+			if (*free_slot == NULL)
+				*free_slot = s;
+			break;
+		}
+	}
+
+	return NULL;
+}
+
+static void fdb_lock(void)
+{
+	while (__atomic_exchange_n(&fdb->lock, 1, __ATOMIC_ACQUIRE))
+		while (LOAD(&fdb->lock))
+			sched_yield();
+}
+
+static void fdb_unlock(void)
+{
+	STORE(&fdb->lock, 0);
+}
+
+void fdb_learn(uint64_t key, int port, unsigned int now)
+{
+	uint32_t vlan = (key >> 48) & (FDB_MAX_VLANS - 1);
+	struct fdb_slot *s, *free_slot;
+
+	s = fdb_find(key, &free_slot);
+	if (s == NULL)
+	{
+		/* A new mac is added under the lock: another worker may have
+		 * added it meanwhile, and fdb_reclaim must not end the probe
+		 * sequence before the slot it is added in */
+		fdb_lock();
+		s = fdb_find(key, &free_slot);
+		if (s == NULL && free_slot != NULL &&
+		    LOAD(&fdb->count) < fdb->max_entries &&
+		    LOAD(&fdb->vlan_count[vlan]) < fdb->max_vlan_entries)
+		{
+			free_slot->move_start = now;
+			free_slot->moves = 0;
+			free_slot->frozen = 0;
+			STORE(&free_slot->stamp, now);
+			STORE(&free_slot->key, FDB_USED | key);
+			STORE(&free_slot->port, port);
+
+			__atomic_add_fetch(&fdb->count, 1, __ATOMIC_RELAXED);
+			__atomic_add_fetch(&fdb->vlan_count[vlan], 1,
+					   __ATOMIC_RELAXED);
+		}
+		fdb_unlock();
+
+		if (s == NULL)
+			return;
+	}
+
+	if (LOAD(&s->stamp) != now)
+		STORE(&s->stamp, now);
+
+	/* the table is only written when the mac changed port */
+	if (LOAD(&s->port) != port)
+		fdb_move(s, key, port, now);
+}
+
+int fdb_lookup(uint64_t key)
+{
+	uint64_t used = FDB_USED | key;
+	uint32_t i = fdb_hash(key) & fdb->mask;
+
+	for (uint32_t probe = 0; probe <= fdb->mask; probe++)
+	{
+		struct fdb_slot *s = &fdb->slots[(i + probe) & fdb->mask];
+		uint64_t k = LOAD(&s->key);
+
+		if (k == used)
+			return LOAD(&s->port);
+		if (k == 0)
+			break;
+	}
+
+	return -1;
+}
+
+static void fdb_remove(struct fdb_slot *s, uint64_t key)
+{
+	uint32_t vlan = (key >> 48) & (FDB_MAX_VLANS - 1);
+
+	STORE(&s->port, -1);
+	STORE(&s->key, FDB_DELETED);
+	__atomic_sub_fetch(&fdb->count, 1, __ATOMIC_RELAXED);
+	__atomic_sub_fetch(&fdb->vlan_count[vlan], 1, __ATOMIC_RELAXED);
+}
+
+/*
+ * A removed slot whose next slot ends the probe sequence anyway is freed, so
+ * that the sequences do not keep growing. It is freed under the lock of the
+ * learners, none of them is adding a mac after it then
+ */
+static void fdb_reclaim(int64_t i)
+{
+	struct fdb_slot *s = &fdb->slots[i];
+	struct fdb_slot *next = &fdb->slots[(i + 1) & fdb->mask];
+
+	if (LOAD(&s->key) != FDB_DELETED || LOAD(&next->key) != 0)
+		return;
+
+	fdb_lock();
+	if (LOAD(&s->key) == FDB_DELETED && LOAD(&next->key) == 0)
+		STORE(&s->key, 0);
+	fdb_unlock();
+}
+
+/*
+ * Only the control process removes entries (expire and flush), so a slot is
+ * never removed by two processes at once. The table is walked backwards, so
+ * the slots freed by fdb_reclaim free the ones before them in turn
+ */
+int fdb_expire(unsigned int now, unsigned int aging)
+{
+	int removed = 0;
+
+	for (int64_t i = fdb->mask; i >= 0; i--)
+	{
+		struct fdb_slot *s = &fdb->slots[i];
+		uint64_t k = LOAD(&s->key);
+
+		if (k != 0 && k != FDB_DELETED && LOAD(&s->port) != -1 &&
+		    now - LOAD(&s->stamp) >= aging)
+		{
+			fdb_remove(s, k);
+			removed++;
+		}
+
+		fdb_reclaim(i);
+	}
+
+	return removed;
+}
+
+int fdb_flush(const int *ports, int count, int vlan)
+{
+	int removed = 0;
+
+	for (int64_t i = fdb->mask; i >= 0; i--)
+	{
+		struct fdb_slot *s = &fdb->slots[i];
+		uint64_t k = LOAD(&s->key);
+		int port = LOAD(&s->port);
+
+		if (k == 0 || k == FDB_DELETED || port == -1)
+			continue;
+		if (vlan >= 0 && ((k >> 48) & (FDB_MAX_VLANS - 1)) != (uint32_t)vlan)
+			continue;
+
+		for (int j = 0; j < count; j++)
+		{
+			if (ports[j] == port)
+			{
+				fdb_remove(s, k);
+				fdb_reclaim(i);
+				removed++;
+				break;
+			}
+		}
+	}
+
+	return removed;
+}
+
+int fdb_count(void)
+{
+	return LOAD(&fdb->count);
+}
+
+int fdb_entries(uint64_t *keys, int *ports, unsigned int *stamps, int *frozen,
+		int max, unsigned int now)
+{
+	int n = 0;
+
+	for (uint32_t i = 0; i <= fdb->mask && n < max; i++)
+	{
+		struct fdb_slot *s = &fdb->slots[i];
+		uint64_t k = LOAD(&s->key);
+		int port = LOAD(&s->port);
+
+		if (k == 0 || k == FDB_DELETED || port == -1)
+			continue;
+
+		keys[n] = k & ~FDB_USED;
+		ports[n] = port;
+		stamps[n] = LOAD(&s->stamp);
+		frozen[n] = now < LOAD(&s->frozen);
+		n++;
+	}
+
+	return n;
+}
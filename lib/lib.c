@@ -1,4 +1,6 @@
+#define _GNU_SOURCE
 #include "lib.h"
+#include "ring.h"
 
 #include <sys/ioctl.h>
 #include <net/if.h>
@@ -16,8 +18,29 @@
 #include <sys/socket.h>
 #include <netinet/in.h>
 #include <arpa/inet.h>
+#include <errno.h>
+#include <sys/epoll.h>
+#include <sys/prctl.h>
+#include <sys/uio.h>
+#include <signal.h>
+#include <linux/ethtool.h>
+#include <linux/sockios.h>
+#include <linux/netlink.h>
+#include <linux/rtnetlink.h>
 
-int interfaces[SWITCH_NUM_INTERFACES];
+int *interfaces;
+int num_interfaces;
+
+/*
+ * Readiness of all the interfaces comes from a single epoll instance. The
+ * events of the last epoll_wait are served one frame per interface before
+ * waiting again, so every ready interface gets its turn; level triggered
+ * epoll reports an interface that still has frames again at the next wait
+ */
+int epoll_fd;
+static struct epoll_event *ready;
+static int nready, next_ready;
+static unsigned int batch_round;
 
 int get_sock(const char *if_name)
 {
@@ -40,25 +63,109 @@ int get_sock(const char *if_name)
 	return s;
 }
 
+/* A frame sent on an interface that is down is dropped, the switch goes on */
+static int write_frame(int intidx, const struct iovec *iov, int iovcnt)
+{
+	int ret = writev(interfaces[intidx], iov, iovcnt);
+
+	if (ret == -1 && (errno == ENETDOWN || errno == ENXIO ||
+			  errno == ENOBUFS || errno == EAGAIN))
+		return -1;
+	DIE(ret == -1, "writev");
+	return ret;
+}
+
 int send_to_link(int intidx, char *frame_data, size_t len)
 {
 	/*
 	 * Note that "buffer" should be at least the MTU size of the
 	 * interface, eg 1500 bytes
 	 */
-	int ret;
-	ret = write(interfaces[intidx], frame_data, len);
-	DIE(ret == -1, "write");
-	return ret;
+	struct iovec iov = { .iov_base = frame_data, .iov_len = len };
+
+	if (ring_enabled())
+		return ring_send(intidx, frame_data, len);
+
+	return write_frame(intidx, &iov, 1);
+}
+
+int send_to_many(int *untagged, int nuntagged, int *tagged, int ntagged,
+		 char *frame_data, size_t len, int is_tagged, char *tag)
+{
+	/*
+	 * Every interface has its own socket, so sendmmsg (one socket, many
+	 * messages) does not apply; the loop runs here instead of in python.
+	 * The frame as received is one piece; the other representation is
+	 * gathered from its macs, the tag (to add it) and the rest of the frame
+	 * (after the tag, to remove it), without rewriting or copying it
+	 */
+	struct iovec as_is = { .iov_base = frame_data, .iov_len = len };
+	struct iovec other[3] = {
+		{ .iov_base = frame_data, .iov_len = 12 },
+		{ .iov_base = tag, .iov_len = VLAN_TAG_LEN },
+		{ .iov_base = frame_data + 12, .iov_len = len - 12 },
+	};
+	int other_cnt = 3;
+	int *same = untagged, *rest = tagged;
+	int nsame = nuntagged, nrest = ntagged;
+	int sent = 0;
+
+	if (is_tagged)
+	{
+		same = tagged;
+		nsame = ntagged;
+		rest = untagged;
+		nrest = nuntagged;
+		other[1].iov_base = frame_data + 12 + VLAN_TAG_LEN;
+		other[1].iov_len = len - 12 - VLAN_TAG_LEN;
+		other_cnt = 2;
+	}
+
+	if (ring_enabled())
+	{
+		/* queue everything first, then one flush per interface */
+		for (int i = 0; i < nsame; i++)
+			ring_queue_iov(same[i], &as_is, 1);
+		for (int i = 0; i < nrest; i++)
+			ring_queue_iov(rest[i], other, other_cnt);
+
+		for (int i = 0; i < nsame; i++)
+			ring_kick(same[i]);
+		for (int i = 0; i < nrest; i++)
+			ring_kick(rest[i]);
+
+		return nsame + nrest;
+	}
+
+	for (int i = 0; i < nsame; i++)
+		sent += write_frame(same[i], &as_is, 1) != -1;
+	for (int i = 0; i < nrest; i++)
+		sent += write_frame(rest[i], other, other_cnt) != -1;
+
+	return sent;
 }
 
 ssize_t receive_from_link(int intidx, char *frame_data)
 {
 	ssize_t ret;
-	ret = read(interfaces[intidx], frame_data, MAX_PACKET_LEN);
+	ret = recv(interfaces[intidx], frame_data, MAX_PACKET_LEN, MSG_DONTWAIT);
 	return ret;
 }
 
+/* Waits until some interface is ready. Returns -1 if interrupted by a signal */
+static int wait_ready(void)
+{
+	int res = epoll_wait(epoll_fd, ready, num_interfaces, -1);
+
+	if (res == -1 && errno == EINTR)
+		return -1;
+	DIE(res == -1, "epoll_wait");
+
+	nready = res;
+	next_ready = 0;
+	return res;
+}
+
 int socket_receive_message(int sockfd, char *frame_data, size_t *len)
 {
 	/*
@@ -73,34 +180,105 @@ int socket_receive_message(int sockfd, char *frame_data, size_t *len)
 
 int recv_from_any_link(char *frame_data, size_t *length)
 {
+	while (1)
+	{
+		if (next_ready == nready && wait_ready() < 0)
+			return -1;
+
+		int i = ready[next_ready++].data.u32;
+		ssize_t ret = receive_from_link(i, frame_data);
+		if (ret < 0)
+			continue;
+		*length = ret;
+		return i;
+	}
+
+	return -1;
+}
+
+/* Receives up to want frames of an interface without blocking, frame j at
+ * frames + j * stride. Returns: the number of frames, -1 if there are none */
+static int recv_many(int intidx, char *frames, size_t stride, size_t *lengths,
+		     int want)
+{
+	struct mmsghdr msgs[MAX_BATCH];
+	struct iovec iovs[MAX_BATCH];
 	int res;
-	fd_set set;
 
-	FD_ZERO(&set);
-	while (1)
+	memset(msgs, 0, want * sizeof(msgs[0]));
+	for (int j = 0; j < want; j++)
 	{
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++)
-		{
-			FD_SET(interfaces[i], &set);
-		}
+		iovs[j].iov_base = frames + j * stride;
+		iovs[j].iov_len = MAX_PACKET_LEN;
+		msgs[j].msg_hdr.msg_iov = &iovs[j];
+		msgs[j].msg_hdr.msg_iovlen = 1;
+	}
+
+	res = recvmmsg(interfaces[intidx], msgs, want, MSG_DONTWAIT, NULL);
+	for (int j = 0; j < res; j++)
+		lengths[j] = msgs[j].msg_len;
+
+	return res;
+}
+
+int recv_batch(char *frames, size_t stride, int *ports, size_t *lengths,
+	       int max_frames)
+{
+	int count = 0;
+	int res;
+
+	if (max_frames > MAX_BATCH)
+		max_frames = MAX_BATCH;
+
+	while (count == 0)
+	{
+		if (wait_ready() < 0)
+			return 0;
 
-		res = select(interfaces[SWITCH_NUM_INTERFACES - 1] + 1, &set, NULL, NULL, NULL);
-		DIE(res == -1, "select");
+		/*
+		 * Every ready interface gets a quantum of the batch and the one
+		 * served first rotates between calls, so a busy interface can not
+		 * fill the batch while the others wait. Frame i goes at
+		 * frames + i * stride
+		 */
+		int quantum = max_frames / nready;
+		if (quantum == 0)
+			quantum = 1;
 
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++)
+		for (int k = 0; k < nready && count < max_frames; k++)
 		{
-			if (FD_ISSET(interfaces[i], &set))
-			{
-				ssize_t ret = receive_from_link(i, frame_data);
-				if (ret < 0)
-					continue;
-				*length = ret;
-				return i;
-			}
+			int i = ready[(k + batch_round) % nready].data.u32;
+			int want = max_frames - count;
+			if (want > quantum)
+				want = quantum;
+
+			res = recv_many(i, frames + count * stride, stride,
+					lengths + count, want);
+			for (int j = 0; j < res; j++)
+				ports[count++] = i;
 		}
+
+		batch_round++;
 	}
 
-	return -1;
+	/* the events were consumed here, recv_from_any_link waits again */
+	nready = next_ready = 0;
+	return count;
+}
+
+int recv_link_batch(int interface, char *frames, size_t stride,
+		    size_t *lengths, int max_frames)
+{
+	if (max_frames > MAX_BATCH)
+		max_frames = MAX_BATCH;
+
+	int res = recv_many(interface, frames, stride, lengths, max_frames);
+	return res < 0 ? 0 : res;
+}
+
+int get_interface_fd(int interface)
+{
+	return interfaces[interface];
 }
 
 char *get_interface_ip(int interface)
@@ -129,14 +307,137 @@ char *get_interface_name(int interface)
 		sprintf(ifr.ifr_name, "r-%u", interface - 1);
 	}
 
+	/* ctypes copies the returned string, so a static buffer is enough */
+	static char int_name[IFNAMSIZ];
+
 	ifr.ifr_ifindex = interface + 2;
 	ret = ioctl(interfaces[interface], SIOCGIFNAME, &ifr);
 	DIE(ret == -1, "ioctl SIOCGIFNAME");
-	char *int_name = malloc(256);
-	strncpy(int_name, ifr.ifr_name, 256);
+	strncpy(int_name, ifr.ifr_name, IFNAMSIZ);
 	return int_name;
 }
 
+int link_up(int interface)
+{
+	struct ifreq ifr;
+	int ret;
+
+	strncpy(ifr.ifr_name, get_interface_name(interface), IFNAMSIZ);
+	ret = ioctl(interfaces[interface], SIOCGIFFLAGS, &ifr);
+	DIE(ret == -1, "ioctl SIOCGIFFLAGS");
+
+	/* IFF_RUNNING is only set while the interface is up and has carrier */
+	return (ifr.ifr_flags & IFF_RUNNING) != 0;
+}
+
+int set_link_up(int interface, int up)
+{
+	struct ifreq ifr;
+
+	strncpy(ifr.ifr_name, get_interface_name(interface), IFNAMSIZ);
+	if (ioctl(interfaces[interface], SIOCGIFFLAGS, &ifr) == -1)
+		return -1;
+
+	if (up)
+		ifr.ifr_flags |= IFF_UP;
+	else
+		ifr.ifr_flags &= ~IFF_UP;
+
+	return ioctl(interfaces[interface], SIOCSIFFLAGS, &ifr) == -1 ? -1 : 0;
+}
+
+/* the rtnetlink socket of link_events_open and the ifindex of every
+ * interface, to tell the messages about them from the other ones */
+static int link_events_fd = -1;
+static int *ifindexes;
+
+int link_events_open(void)
+{
+	struct sockaddr_nl addr = {
+		.nl_family = AF_NETLINK,
+		.nl_groups = RTMGRP_LINK,
+	};
+
+	link_events_fd = socket(AF_NETLINK,
+				SOCK_RAW | SOCK_NONBLOCK | SOCK_CLOEXEC,
+				NETLINK_ROUTE);
+	if (link_events_fd == -1)
+		return -1;
+
+	if (bind(link_events_fd, (struct sockaddr *)&addr, sizeof(addr)) == -1)
+	{
+		close(link_events_fd);
+		link_events_fd = -1;
+		return -1;
+	}
+
+	ifindexes = malloc(num_interfaces * sizeof(int));
+	DIE(ifindexes == NULL, "malloc");
+	for (int i = 0; i < num_interfaces; i++)
+		ifindexes[i] = if_nametoindex(get_interface_name(i));
+
+	return link_events_fd;
+}
+
+int read_link_events(void)
+{
+	char buf[8192] __attribute__((aligned(NLMSG_ALIGNTO)));
+	int events = 0;
+	ssize_t len;
+
+	while ((len = recv(link_events_fd, buf, sizeof(buf), 0)) != 0)
+	{
+		if (len == -1)
+		{
+			/* the socket overflowed, some changes were lost */
+			if (errno == ENOBUFS)
+			{
+				events++;
+				continue;
+			}
+			if (errno == EINTR)
+				continue;
+			break;
+		}
+
+		for (struct nlmsghdr *nh = (struct nlmsghdr *)buf;
+		     NLMSG_OK(nh, len); nh = NLMSG_NEXT(nh, len))
+		{
+			struct ifinfomsg *ifi = NLMSG_DATA(nh);
+
+			if (nh->nlmsg_type != RTM_NEWLINK &&
+			    nh->nlmsg_type != RTM_DELLINK)
+				continue;
+
+			for (int i = 0; i < num_interfaces; i++)
+				if (ifindexes[i] == ifi->ifi_index)
+					events++;
+		}
+	}
+
+	return events;
+}
+
+int link_speed(int interface)
+{
+	struct ethtool_cmd cmd = { .cmd = ETHTOOL_GSET };
+	struct ifreq ifr;
+	uint32_t speed;
+
+	strncpy(ifr.ifr_name, get_interface_name(interface), IFNAMSIZ);
+	ifr.ifr_data = (void *)&cmd;
+
+	/* not every driver has link settings, then the speed is unknown */
+	if (ioctl(interfaces[interface], SIOCETHTOOL, &ifr) == -1)
+		return -1;
+
+	speed = ethtool_cmd_speed(&cmd);
+	if (speed == 0 || speed == (uint32_t)SPEED_UNKNOWN)
+		return -1;
+
+	return speed;
+}
+
 void get_interface_mac(int interface, uint8_t *mac)
 {
 	struct ifreq ifr;
@@ -198,11 +499,64 @@ int hwaddr_aton(const char *txt, uint8_t *addr)
 
 int init(int argc, char *argv[])
 {
+	return init_mode(argc, argv, IO_SOCKET);
+}
+
+int get_io_mode(void)
+{
+	return ring_enabled() ? IO_RING : IO_SOCKET;
+}
+
+int init_mode(int argc, char *argv[], int mode)
+{
+	struct epoll_event ev;
+	int res;
+
+	num_interfaces = argc;
+	interfaces = malloc(argc * sizeof(*interfaces));
+	ready = malloc(argc * sizeof(*ready));
+	DIE(argc && (interfaces == NULL || ready == NULL), "malloc");
+
+	epoll_fd = epoll_create1(0);
+	DIE(epoll_fd == -1, "epoll_create1");
+
 	for (int i = 0; i < argc; ++i)
 	{
 		printf("Setting up interface: %s\n", argv[i]);
 		interfaces[i] = get_sock(argv[i]);
+
+		ev.events = EPOLLIN;
+		ev.data.u32 = i;
+		res = epoll_ctl(epoll_fd, EPOLL_CTL_ADD, interfaces[i], &ev);
+		DIE(res == -1, "epoll_ctl");
 	}
 
+	if (mode == IO_RING && ring_setup(argv))
+		printf("PACKET_MMAP rings unavailable, using plain sockets\n");
+
 	return argc;
 }
+
+void init_worker(int *rx_interfaces, int count)
+{
+	struct epoll_event ev;
+	int res;
+
+	/* the workers go away with the control process */
+	prctl(PR_SET_PDEATHSIG, SIGTERM);
+
+	/* the epoll instance is shared with the parent, this one is private */
+	close(epoll_fd);
+	epoll_fd = epoll_create1(0);
+	DIE(epoll_fd == -1, "epoll_create1");
+	nready = next_ready = 0;
+
+	for (int i = 0; i < count; i++)
+	{
+		ev.events = EPOLLIN;
+		ev.data.u32 = rx_interfaces[i];
+		res = epoll_ctl(epoll_fd, EPOLL_CTL_ADD,
+				interfaces[rx_interfaces[i]], &ev);
+		DIE(res == -1, "epoll_ctl");
+	}
+}
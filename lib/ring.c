@@ -0,0 +1,347 @@
+#include "lib.h"
+#include "ring.h"
+
+#include <errno.h>
+#include <string.h>
+#include <pthread.h>
+#include <sys/ioctl.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/epoll.h>
+#include <net/if.h>
+#include <netinet/in.h>
+#include <linux/if_ether.h>
+#include <linux/if_packet.h>
+
+struct ring {
+	int rx_fd;
+	char *rx_map;
+	unsigned int rx_block;
+
+	int tx_fd;
+	char *tx_map;
+	unsigned int tx_frame;
+	int tx_pending;
+};
+
+static struct ring *rings;
+static unsigned int rx_round;
+
+/*
+ * The TX rings are shared by the data path and the control plane thread,
+ * which sends the BPDUs (the workers and the asyncio mode use sockets). Only
+ * the data path defers its kicks, so tx_deferred is per thread
+ */
+static pthread_mutex_t tx_lock = PTHREAD_MUTEX_INITIALIZER;
+static __thread int tx_deferred;
+
+static int bind_ring(int fd, int ifindex, int protocol)
+{
+	struct sockaddr_ll addr;
+	memset(&addr, 0x00, sizeof(addr));
+	addr.sll_family = AF_PACKET;
+	addr.sll_protocol = protocol;
+	addr.sll_ifindex = ifindex;
+
+	return bind(fd, (struct sockaddr *)&addr, sizeof(addr));
+}
+
+static int setup_rx(struct ring *r, int ifindex)
+{
+	int version = TPACKET_V3;
+	int reserve = RING_HEADROOM;
+	int one = 1;
+	struct tpacket_req3 req;
+
+	r->rx_fd = socket(AF_PACKET, SOCK_RAW, htons(ETH_P_ALL));
+	if (r->rx_fd == -1)
+		return -1;
+
+	/* the frames sent from the TX socket must not come back here */
+	if (setsockopt(r->rx_fd, SOL_PACKET, PACKET_VERSION, &version,
+		       sizeof(version)) == -1 ||
+	    setsockopt(r->rx_fd, SOL_PACKET, PACKET_RESERVE, &reserve,
+		       sizeof(reserve)) == -1 ||
+	    setsockopt(r->rx_fd, SOL_PACKET, PACKET_IGNORE_OUTGOING, &one,
+		       sizeof(one)) == -1)
+		return -1;
+
+	memset(&req, 0, sizeof(req));
+	req.tp_block_size = RX_BLOCK_SIZE;
+	req.tp_block_nr = RX_BLOCK_NR;
+	req.tp_frame_size = RX_FRAME_SIZE;
+	req.tp_frame_nr = RX_BLOCK_SIZE / RX_FRAME_SIZE * RX_BLOCK_NR;
+	req.tp_retire_blk_tov = RX_BLOCK_TIMEOUT;
+	if (setsockopt(r->rx_fd, SOL_PACKET, PACKET_RX_RING, &req,
+		       sizeof(req)) == -1)
+		return -1;
+
+	r->rx_map = mmap(NULL, RX_BLOCK_SIZE * RX_BLOCK_NR,
+			 PROT_READ | PROT_WRITE, MAP_SHARED, r->rx_fd, 0);
+	if (r->rx_map == MAP_FAILED)
+	{
+		r->rx_map = NULL;
+		return -1;
+	}
+
+	return bind_ring(r->rx_fd, ifindex, htons(ETH_P_ALL));
+}
+
+static int setup_tx(struct ring *r, int ifindex)
+{
+	int version = TPACKET_V2;
+	struct tpacket_req req;
+
+	/* protocol 0, this socket never receives anything */
+	r->tx_fd = socket(AF_PACKET, SOCK_RAW, 0);
+	if (r->tx_fd == -1)
+		return -1;
+
+	if (setsockopt(r->tx_fd, SOL_PACKET, PACKET_VERSION, &version,
+		       sizeof(version)) == -1)
+		return -1;
+
+	memset(&req, 0, sizeof(req));
+	req.tp_block_size = TX_BLOCK_SIZE;
+	req.tp_block_nr = TX_BLOCK_NR;
+	req.tp_frame_size = TX_FRAME_SIZE;
+	req.tp_frame_nr = TX_FRAME_NR;
+	if (setsockopt(r->tx_fd, SOL_PACKET, PACKET_TX_RING, &req,
+		       sizeof(req)) == -1)
+		return -1;
+
+	r->tx_map = mmap(NULL, TX_BLOCK_SIZE * TX_BLOCK_NR,
+			 PROT_READ | PROT_WRITE, MAP_SHARED, r->tx_fd, 0);
+	if (r->tx_map == MAP_FAILED)
+	{
+		r->tx_map = NULL;
+		return -1;
+	}
+
+	return bind_ring(r->tx_fd, ifindex, 0);
+}
+
+static void ring_teardown(void)
+{
+	for (int i = 0; i < num_interfaces; i++)
+	{
+		struct ring *r = &rings[i];
+		if (r->rx_map)
+			munmap(r->rx_map, RX_BLOCK_SIZE * RX_BLOCK_NR);
+		if (r->tx_map)
+			munmap(r->tx_map, TX_BLOCK_SIZE * TX_BLOCK_NR);
+		if (r->rx_fd != -1)
+			close(r->rx_fd);
+		if (r->tx_fd != -1)
+			close(r->tx_fd);
+	}
+
+	free(rings);
+	rings = NULL;
+}
+
+int ring_setup(char *argv[])
+{
+	struct epoll_event ev;
+	struct ifreq intf;
+	int res;
+
+	rings = calloc(num_interfaces, sizeof(*rings));
+	DIE(num_interfaces && rings == NULL, "calloc");
+	for (int i = 0; i < num_interfaces; i++)
+		rings[i].rx_fd = rings[i].tx_fd = -1;
+
+	for (int i = 0; i < num_interfaces; i++)
+	{
+		strncpy(intf.ifr_name, argv[i], IFNAMSIZ - 1);
+		intf.ifr_name[IFNAMSIZ - 1] = '\0';
+		res = ioctl(interfaces[i], SIOCGIFINDEX, &intf);
+		DIE(res, "ioctl SIOCGIFINDEX");
+
+		if (setup_rx(&rings[i], intf.ifr_ifindex) ||
+		    setup_tx(&rings[i], intf.ifr_ifindex))
+		{
+			ring_teardown();
+			return -1;
+		}
+	}
+
+	/* every ring is ready, the plain sockets can go */
+	for (int i = 0; i < num_interfaces; i++)
+	{
+		epoll_ctl(epoll_fd, EPOLL_CTL_DEL, interfaces[i], NULL);
+		close(interfaces[i]);
+		interfaces[i] = rings[i].rx_fd;
+
+		ev.events = EPOLLIN;
+		ev.data.u32 = i;
+		res = epoll_ctl(epoll_fd, EPOLL_CTL_ADD, interfaces[i], &ev);
+		DIE(res == -1, "epoll_ctl");
+	}
+
+	return 0;
+}
+
+int ring_enabled(void)
+{
+	return rings != NULL;
+}
+
+static struct tpacket_block_desc *rx_desc(struct ring *r)
+{
+	return (void *)(r->rx_map + r->rx_block * RX_BLOCK_SIZE);
+}
+
+int ring_next_block(size_t *offset)
+{
+	struct epoll_event ev;
+	int res;
+
+	while (1)
+	{
+		for (int k = 0; k < num_interfaces; k++)
+		{
+			int i = (rx_round + k) % num_interfaces;
+			struct ring *r = &rings[i];
+
+			if (rx_desc(r)->hdr.bh1.block_status & TP_STATUS_USER)
+			{
+				__sync_synchronize();
+				rx_round = i + 1;
+				*offset = (size_t)r->rx_block * RX_BLOCK_SIZE;
+				return i;
+			}
+		}
+
+		/* no block is ready, sleep until a ring has one */
+		res = epoll_wait(epoll_fd, &ev, 1, -1);
+		if (res == -1 && errno == EINTR)
+			return -1;
+		DIE(res == -1, "epoll_wait");
+	}
+}
+
+void ring_release_block(int interface)
+{
+	struct ring *r = &rings[interface];
+
+	__sync_synchronize();
+	rx_desc(r)->hdr.bh1.block_status = TP_STATUS_KERNEL;
+	r->rx_block = (r->rx_block + 1) % RX_BLOCK_NR;
+}
+
+char *ring_rx_map(int interface, size_t *size)
+{
+	*size = RX_BLOCK_SIZE * RX_BLOCK_NR;
+	return rings[interface].rx_map;
+}
+
+static struct tpacket2_hdr *tx_slot(struct ring *r)
+{
+	return (void *)(r->tx_map + r->tx_frame * TX_FRAME_SIZE);
+}
+
+/* called with tx_lock held, flags 0 waits for the ring to drain */
+static void tx_flush(struct ring *r, int flags)
+{
+	int ret;
+
+	if (!r->tx_pending)
+		return;
+
+	/* on EAGAIN (or while the link is down) the frames stay queued for the
+	 * next flush */
+	ret = send(r->tx_fd, NULL, 0, flags);
+	if (ret == -1 && (errno == EAGAIN || errno == ENOBUFS ||
+			  errno == ENETDOWN || errno == ENXIO))
+		return;
+	DIE(ret == -1, "send");
+	r->tx_pending = 0;
+}
+
+int ring_queue(int interface, char *frame_data, size_t len)
+{
+	struct iovec iov = { .iov_base = frame_data, .iov_len = len };
+
+	return ring_queue_iov(interface, &iov, 1);
+}
+
+int ring_queue_iov(int interface, const struct iovec *iov, int iovcnt)
+{
+	struct ring *r = &rings[interface];
+	struct tpacket2_hdr *hdr;
+	size_t len = 0;
+	char *data;
+
+	for (int i = 0; i < iovcnt; i++)
+		len += iov[i].iov_len;
+	if (len > TX_FRAME_SIZE - TPACKET2_HDRLEN)
+		return -1;
+
+	pthread_mutex_lock(&tx_lock);
+
+	hdr = tx_slot(r);
+	if (hdr->tp_status != TP_STATUS_AVAILABLE)
+	{
+		/* the ring is full, wait for the kernel to send some of it */
+		r->tx_pending = 1;
+		tx_flush(r, 0);
+	}
+
+	if (hdr->tp_status & TP_STATUS_WRONG_FORMAT)
+		hdr->tp_status = TP_STATUS_AVAILABLE;
+
+	if (hdr->tp_status != TP_STATUS_AVAILABLE)
+	{
+		pthread_mutex_unlock(&tx_lock);
+		return -1;
+	}
+
+	/* the pieces are gathered straight into the slot */
+	data = (char *)hdr + TPACKET_ALIGN(sizeof(*hdr));
+	for (int i = 0; i < iovcnt; i++)
+	{
+		memcpy(data, iov[i].iov_base, iov[i].iov_len);
+		data += iov[i].iov_len;
+	}
+	hdr->tp_len = len;
+	__sync_synchronize();
+	hdr->tp_status = TP_STATUS_SEND_REQUEST;
+
+	r->tx_frame = (r->tx_frame + 1) % TX_FRAME_NR;
+	r->tx_pending = 1;
+
+	pthread_mutex_unlock(&tx_lock);
+	return len;
+}
+
+void ring_kick(int interface)
+{
+	if (tx_deferred)
+		return;
+
+	pthread_mutex_lock(&tx_lock);
+	tx_flush(&rings[interface], MSG_DONTWAIT);
+	pthread_mutex_unlock(&tx_lock);
+}
+
+int ring_send(int interface, char *frame_data, size_t len)
+{
+	int ret = ring_queue(interface, frame_data, len);
+
+	ring_kick(interface);
+	return ret;
+}
+
+void ring_defer_tx(int on)
+{
+	tx_deferred = on;
+}
+
+void ring_flush(void)
+{
+	pthread_mutex_lock(&tx_lock);
+	for (int i = 0; i < num_interfaces; i++)
+		tx_flush(&rings[i], MSG_DONTWAIT);
+	pthread_mutex_unlock(&tx_lock);
+}
@@ -1,11 +1,447 @@
 # 333CA Dumitrascu Filip-Teodor
 import sys
+import os
+import math
+import mmap
+import pickle
+import select
 import struct
 import wrapper
 import threading
 import time
-from wrapper import recv_from_any_link, send_to_link, get_switch_mac, \
-                    get_interface_name
+import signal
+import asyncio
+from collections import OrderedDict, deque
+from zlib import crc32
+from wrapper import recv_from_any_link, recv_batch, recv_link_batch, \
+                    get_interface_fd, recv_block, release_block, defer_tx, \
+                    flush_tx, send_to_link, send_to_many, port_array, \
+                    get_switch_mac, get_interface_name, link_up, \
+                    set_link_up, link_speed, link_events_open, \
+                    read_link_events, fdb_create, fdb_learn, fdb_lookup, \
+                    fdb_expire, fdb_flush, fdb_count, fdb_entries, \
+                    HEADROOM, IO_SOCKET, IO_RING, MAX_BATCH
+
+class Port:
+    # Compact per-interface record, addressed by the interface index. The
+    # name is resolved only once at startup, the data path never goes
+    # through get_interface_name again. The stp state of a trunk port
+    # (between switches) is kept by its spanning tree, one per vlan with pvst.
+    # A link aggregation group is a trunk port of its own, after the
+    # interfaces: members lists its member ports, which point back to it with
+    # lag. Only the lag is seen by the fdb and the stp, never its members
+    __slots__ = ('idx', 'name', 'trunk', 'vlan', 'lag', 'members')
+
+    def __init__(self, idx, name, vlan):
+        self.idx = idx
+        self.name = name
+        self.trunk = (vlan == 'T')
+        self.vlan = None if self.trunk else vlan
+        self.lag = None
+        self.members = None
+
+    def __repr__(self):
+        mode = "trunk" if self.trunk else f"access {self.vlan}"
+        return f"Port({self.idx}, {self.name}, {mode})"
+
+def build_port_table(num_intrfs, vlan_table, lags):
+    ports = []
+    for i in range(num_intrfs):
+        name = get_interface_name(i)
+        ports.append(Port(i, name, vlan_table[name]))
+
+    by_name = {port.name: port for port in ports}
+    for name, members in lags.items():
+        lag = Port(len(ports), name, 'T')
+        lag.members = [by_name[member] for member in members]
+        for member in lag.members:
+            member.lag = lag
+        ports.append(lag)
+
+    return ports
+
+def physical_ports(ports):
+    # the ports that are interfaces, the ones frames are received on
+    return [port for port in ports if port.members is None]
+
+BPDU_MAC = b"\x01\x80\xC2\x00\x00\x00"
+
+# Optional "option value" lines of the config file and their default values
+CONFIG_OPTIONS = {
+    'aging': 300,           # seconds a learned mac is kept without traffic
+    'fdb-max': 8192,        # max entries in the forwarding database
+    'fdb-max-vlan': 4096,   # max entries a single vlan may use
+    'flap-moves': 5,        # port changes of a mac tolerated in a window
+    'flap-window': 10,      # seconds of the move counting window
+    'flap-hold': 30,        # seconds a flapping mac stays frozen on its port
+    'batch': 0,             # frames per recv_batch call, 0 receives one by one
+    'ring': 0,              # 1 uses PACKET_MMAP rings if available
+    'workers': 0,           # data path processes, 0 runs it in this one
+    'asyncio': 0,           # 1 runs the switch on an asyncio event loop
+    'stats': 0,             # seconds between stats lines (asyncio), 0 is off
+    'forward-delay': 2,     # seconds a trunk spends listening, then learning
+    'max-age': 3,           # seconds the info of a trunk lasts without BPDUs
+    'rstp': 0,              # 1 runs the rapid spanning tree (802.1w)
+    'pvst': 0,              # 1 runs a spanning tree per vlan
+    'storm-errdisable': 0,  # seconds of storm drops that shut a port, 0 never
+    'storm-recovery': 30,   # seconds an err-disabled port stays down,
+                            # 0 = never (stays err-disabled until restarted)
+    'igmp-snooping': 0,     # 1 forwards multicast only to the group members
+    'igmp-timeout': 260,    # seconds a membership or router port lasts
+    'arp-suppression': 0,   # 1 answers the ARP requests of known addresses
+    'arp-aging': 300,       # seconds an IP to mac binding is kept unseen
+}
+
+# Max number of expired FDB entries removed per received frame
+FDB_AGE_BUDGET = 64
+
+def mac_to_str(mac):
+    # human readable format, only used for diagnostics
+    if isinstance(mac, int):
+        mac = mac.to_bytes(6, byteorder='big')
+
+    return ':'.join(f'{b:02x}' for b in mac)
+
+class FDB:
+    # Forwarding database. Every vlan learns independently, the key packs the
+    # vlan and the 48-bit mac in a single int: vlan << 48 | mac.
+    # Besides the key -> port map, the keys are kept ordered by the second
+    # they were last seen in, globally and per vlan. Refreshing an entry
+    # moves it to the end (at most once per second), so the oldest entries
+    # are always first and both aging and eviction are O(1) per entry.
+    # A mac that changes port more than flap_moves times in flap_window
+    # seconds is frozen on its current port for flap_hold seconds
+    __slots__ = ('entries', 'stamps', 'vlans', 'moves', 'frozen', 'aging',
+                 'max_entries', 'max_vlan_entries', 'flap_moves',
+                 'flap_window', 'flap_hold')
+
+    def __init__(self, options):
+        self.entries = {}
+        self.stamps = OrderedDict()
+        self.vlans = {}
+        self.moves = {}
+        self.frozen = {}
+        self.aging = options['aging']
+        self.max_entries = options['fdb-max']
+        self.max_vlan_entries = options['fdb-max-vlan']
+        self.flap_moves = options['flap-moves']
+        self.flap_window = options['flap-window']
+        self.flap_hold = options['flap-hold']
+
+    def learn(self, vlan, mac, port, now):
+        key = (vlan << 48) | int.from_bytes(mac, 'big')
+        stamp = self.stamps.get(key)
+
+        if stamp is None:
+            self.insert(key, vlan, port, now)
+            return
+
+        if stamp != now:
+            self.stamps[key] = now
+            self.stamps.move_to_end(key)
+            self.vlans[vlan].move_to_end(key)
+
+        # the table is only written when the mac changed its port
+        if self.entries[key] != port:
+            self.move(key, port, now)
+
+    def move(self, key, port, now):
+        frozen = self.frozen.get(key)
+        if frozen is not None:
+            if now < frozen:
+                return
+            del self.frozen[key]
+
+        start, count = self.moves.get(key, (now, 0))
+        if now - start >= self.flap_window:
+            start, count = now, 0
+
+        count += 1
+        if count > self.flap_moves:
+            self.moves.pop(key, None)
+            self.frozen[key] = now + self.flap_hold
+            print(f"FDB: {mac_to_str(key & 0xFFFFFFFFFFFF)} in vlan "
+                  f"{key >> 48} is flapping between ports {self.entries[key]} "
+                  f"and {port}, frozen for {self.flap_hold}s", flush=True)
+            return
+
+        self.moves[key] = (start, count)
+        self.entries[key] = port
+
+    def insert(self, key, vlan, port, now):
+        # When a limit is hit the oldest entry (of the vlan) makes room. The
+        # vlan may lose its last entry (and its dict) there, so it is only
+        # looked up after
+        vlan_keys = self.vlans.get(vlan)
+        if vlan_keys is not None and len(vlan_keys) >= self.max_vlan_entries:
+            self.remove(next(iter(vlan_keys)))
+        if len(self.entries) >= self.max_entries:
+            self.remove(next(iter(self.stamps)))
+
+        vlan_keys = self.vlans.setdefault(vlan, OrderedDict())
+        self.entries[key] = port
+        self.stamps[key] = now
+        vlan_keys[key] = None
+
+    def remove(self, key):
+        vlan = key >> 48
+        del self.entries[key]
+        del self.stamps[key]
+        self.moves.pop(key, None)
+        self.frozen.pop(key, None)
+
+        vlan_keys = self.vlans[vlan]
+        del vlan_keys[key]
+        if not vlan_keys:
+            del self.vlans[vlan]
+
+    def age(self, now, budget=FDB_AGE_BUDGET):
+        # Removes the entries not seen for aging seconds. Only the expired
+        # ones at the front are visited and at most budget of them, so a
+        # burst of expirations is spread over the next frames
+        stamps = self.stamps
+        limit = now - self.aging
+
+        while stamps and budget:
+            key, stamp = next(iter(stamps.items()))
+            if stamp > limit:
+                break
+
+            self.remove(key)
+            budget -= 1
+
+        # True if the budget ran out before all the expired entries did
+        return not budget
+
+    def flush(self, ports, vlan=None):
+        # Removes the entries learned on ports, only in vlan if it is given:
+        # after a topology change those macs may be behind another port
+        keys = self.entries if vlan is None else self.vlans.get(vlan, ())
+        stale = [key for key in keys if self.entries[key] in ports]
+        for key in stale:
+            self.remove(key)
+
+        return len(stale)
+
+    def lookup(self, vlan, mac):
+        return self.entries.get((vlan << 48) | int.from_bytes(mac, 'big'))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return format_fdb((key, port, self.stamps[key], key in self.frozen)
+                          for key, port in self.entries.items())
+
+class SharedFDB:
+    # The FDB of the multi-process mode: a hash table in shared memory
+    # (lib/fdb.c) that all the workers learn into and look up in. Same keys,
+    # aging, limits and flap detection as FDB, but a full table does not
+    # evict, new macs are flooded until entries age out. Only the control
+    # process ages the table, once a second, with expire
+    __slots__ = ('aging',)
+
+    def __init__(self, options):
+        self.aging = options['aging']
+        fdb_create(options['fdb-max'], options['fdb-max-vlan'],
+                   options['flap-moves'], options['flap-window'],
+                   options['flap-hold'])
+
+    def learn(self, vlan, mac, port, now):
+        fdb_learn((vlan << 48) | int.from_bytes(mac, 'big'), port, now)
+
+    def lookup(self, vlan, mac):
+        port = fdb_lookup((vlan << 48) | int.from_bytes(mac, 'big'))
+        return port if port >= 0 else None
+
+    def age(self, now, budget=FDB_AGE_BUDGET):
+        # the workers leave aging to the control process
+        pass
+
+    def expire(self, now):
+        return fdb_expire(int(now), self.aging)
+
+    def flush(self, ports, vlan=None):
+        return fdb_flush(ports, vlan)
+
+    def __len__(self):
+        return fdb_count()
+
+    def __str__(self):
+        return format_fdb(fdb_entries(int(time.monotonic())))
+
+def format_fdb(entries):
+    # entries are (key, port, stamp, frozen), printed sorted by vlan and mac
+    now = int(time.monotonic())
+    lines = [f"{'vlan':>4}  {'mac':17}  port  age"]
+    for key, port, stamp, frozen in sorted(entries):
+        frozen = "  frozen" if frozen else ""
+        lines.append(f"{key >> 48:>4}  {mac_to_str(key & 0xFFFFFFFFFFFF)}"
+                     f"  {port:>4}  {now - stamp}{frozen}")
+
+    return '\n'.join(lines)
+
+ARP_MAX_ENTRIES = 8192
+# Ethernet hardware, IPv4 protocol, 6 and 4 byte addresses
+ARP_ETHER_IPV4 = b"\x00\x01\x08\x00\x06\x04"
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+class ArpCache:
+    # IP to mac bindings of every vlan, learned from the ARP replies and the
+    # gratuitous ARPs. The key packs the vlan and the IPv4 address in a
+    # single int, like the FDB: vlan << 32 | ip. A binding not seen again
+    # for aging seconds is dropped when it is looked up, and the least
+    # recently seen one goes when the cache is full. The data path owns it,
+    # with the workers each has its own
+    __slots__ = ('entries', 'aging')
+
+    def __init__(self, options):
+        self.entries = OrderedDict()
+        self.aging = options['arp-aging']
+
+    def learn(self, vlan, ip, mac, now):
+        key = (vlan << 32) | int.from_bytes(ip, 'big')
+        self.entries[key] = (mac, now)
+        self.entries.move_to_end(key)
+        if len(self.entries) > ARP_MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def lookup(self, vlan, ip, now):
+        key = (vlan << 32) | int.from_bytes(ip, 'big')
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        mac, stamp = entry
+        if now - stamp >= self.aging:
+            del self.entries[key]
+            return None
+        return mac
+
+    def __str__(self):
+        lines = ["vlan  ip               mac"]
+        for key, (mac, _) in self.entries.items():
+            ip = '.'.join(str(byte) for byte in (key & 0xFFFFFFFF)
+                          .to_bytes(4, 'big'))
+            lines.append(f"{key >> 32:4}  {ip:15}  {mac_to_str(mac)}")
+
+        return '\n'.join(lines)
+
+def arp_reply(requester, requester_ip, mac, ip):
+    # the reply of mac, which has ip, to an ARP request
+    return requester + mac + b"\x08\x06" + ARP_ETHER_IPV4 + \
+        struct.pack("!H", ARP_REPLY) + mac + ip + requester + requester_ip + \
+        bytes(18)
+
+class Egress:
+    # Where a frame from a given (ingress port, vlan) may go. The trunk ports
+    # get the tagged frame, the access ones the untagged frame and members
+    # maps every egress port to whether it is tagged, for unicast lookups.
+    # The lists are also kept as the int arrays send_to_many takes and the
+    # vlan tag is built once, with the plan, not for every tagged frame.
+    # states are the port states of the spanning tree of the vlan (None if
+    # it has none yet, then the trunks block) and ingress is the one of the
+    # ingress port. A lag gets the tagged frame on one of its members up,
+    # lags maps it to them, the member of a frame is picked by flow_member
+    __slots__ = ('tagged', 'untagged', 'members', 'c_tagged', 'c_untagged',
+                 'tag', 'ingress', 'vlan', 'lags')
+
+    def __init__(self, ports, recv_port, vlan, states):
+        self.tag = create_vlan_tag(vlan)
+        self.vlan = vlan
+        self.tagged = []
+        self.untagged = []
+        self.members = {}
+        self.lags = {}
+
+        if not recv_port.trunk:
+            self.ingress = "forwarding"
+        else:
+            self.ingress = states[recv_port.idx] if states else "blocking"
+
+        for port in ports:
+            if port is recv_port or port.lag is not None:
+                continue
+
+            if port.trunk:
+                if not states or states[port.idx] != "forwarding":
+                    continue
+
+                # the members that are down are "disabled" in the states
+                if port.members is not None:
+                    up = tuple(member.idx for member in port.members
+                               if states[member.idx] == "forwarding")
+                    if not up:
+                        continue
+                    self.lags[port.idx] = up
+                else:
+                    self.tagged.append(port.idx)
+                self.members[port.idx] = True
+
+            elif port.vlan == vlan:
+                self.untagged.append(port.idx)
+                self.members[port.idx] = False
+
+        self.c_tagged = port_array(self.tagged)
+        self.c_untagged = port_array(self.untagged)
+
+    def restrict(self, ports):
+        # the same egress, only towards ports (a set of port indexes)
+        egress = Egress.__new__(Egress)
+        egress.tag = self.tag
+        egress.vlan = self.vlan
+        egress.ingress = self.ingress
+        egress.tagged = [idx for idx in self.tagged if idx in ports]
+        egress.untagged = [idx for idx in self.untagged if idx in ports]
+        egress.members = {idx: tagged for idx, tagged in self.members.items()
+                          if idx in ports}
+        egress.lags = {idx: members for idx, members in self.lags.items()
+                       if idx in ports}
+        egress.c_tagged = port_array(egress.tagged)
+        egress.c_untagged = port_array(egress.untagged)
+        return egress
+
+class EgressPlan:
+    # Precomputed Egress for every (ingress port, vlan). It only depends on
+    # the port config and the stp states, so it is rebuilt when a state
+    # changes instead of being recomputed for every frame. trees is the
+    # snapshot of the states the plan was built from, the states of every
+    # port by vlan, None for the tree of all the vlans
+    __slots__ = ('ports', 'trees', 'vlans', 'entries')
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.trees = {}
+        self.vlans = {port.vlan for port in ports if not port.trunk}
+        self.entries = {}
+
+    def states(self, vlan):
+        return self.trees.get(vlan, self.trees.get(None))
+
+    def refresh(self, trees):
+        self.trees = trees
+        self.entries = {}
+        for port in self.ports:
+            # the frames of the members of a lag are received by the lag
+            if port.lag is not None:
+                continue
+            vlans = self.vlans if port.trunk else (port.vlan,)
+            for vlan in vlans:
+                self.entries[(port.idx, vlan)] = Egress(self.ports, port, vlan,
+                                                        self.states(vlan))
+
+    def lookup(self, recv_intrf, vlan):
+        egress = self.entries.get((recv_intrf, vlan))
+
+        # A vlan with no local access port can still transit between trunks.
+        # Untagged frames on a trunk have no vlan and are not forwarded
+        if egress is None and vlan != -1:
+            egress = Egress(self.ports, self.ports[recv_intrf], vlan,
+                            self.states(vlan))
+            self.entries[(recv_intrf, vlan)] = egress
+
+        return egress
 
 def parse_ethernet_header(data):
     # Unpack the header fields from the byte array
@@ -25,16 +461,57 @@ def parse_ethernet_header(data):
 
     return dest_mac, src_mac, ether_type, vlan_id
 
-def parse_config_file(sw_id, vlan_table):
+def parse_config_file(sw_id, vlan_table, options):
     with open(f"./configs/switch{sw_id}.cfg") as fin:
         lines = fin.readlines()
 
     # First line int the file is the switch priority
     sw_priority = int(lines[0].strip())
 
-    # Next ones are "interface vlanid" format 
+    options.update(CONFIG_OPTIONS)
+    options['stp-priorities'] = {}
+    options['path-costs'] = {}
+    options['lags'] = {}
+    options['storm-control'] = {}
+
+    # Next ones are "interface vlanid" format, "option value",
+    # "stp-priority vlanid priority", the priority of the tree of a vlan
+    # with pvst (the switch priority by default), "path-cost interface
+    # cost", the stp cost of a trunk (derived from its speed by default),
+    # "lag name interface...", a link aggregation group of trunk interfaces
+    # or "storm-control interface class rate [burst]", the frames per second
+    # of a class of flooded traffic the interface may receive
     for line in lines[1:]:
-        intrf_name, vlan_id = line.strip().split()
+        fields = line.split()
+        if not fields:
+            continue
+
+        if fields[0] in CONFIG_OPTIONS:
+            options[fields[0]] = int(fields[1])
+            continue
+
+        if fields[0] == 'stp-priority':
+            options['stp-priorities'][int(fields[1])] = int(fields[2])
+            continue
+
+        if fields[0] == 'path-cost':
+            options['path-costs'][fields[1]] = int(fields[2])
+            continue
+
+        if fields[0] == 'lag':
+            options['lags'][fields[1]] = fields[2:]
+            for member in fields[2:]:
+                vlan_table[member] = 'T'
+            continue
+
+        if fields[0] == 'storm-control':
+            rate = int(fields[3])
+            burst = int(fields[4]) if len(fields) > 4 else rate
+            options['storm-control'].setdefault(fields[1], {})[fields[2]] = \
+                (rate, burst)
+            continue
+
+        intrf_name, vlan_id = fields
 
         # Trunk interfaces
         if vlan_id == 'T':
@@ -44,194 +521,1573 @@ def parse_config_file(sw_id, vlan_table):
     
     return sw_priority
 
-def parse_bpdu_frame(data, recv_intrf, stp, intrfs, intrfs_sts, vlan_table):
-    recv_name = get_interface_name(recv_intrf)
-    was_root = (stp['own_brd_id'] == stp['root_brd_id'])
-
-    # Unpacks the data in the format the bpdu was decided to be stored
-    dest_mac, src_mac, bpdu_own_brd_id, bpdu_root_brd_id, \
-    bpdu_root_pth_cost = struct.unpack("!6s6sIII", data)
-
-    # The assumed root bridge considered by the bpdu frame is more
-    # appropriate (smaller) than the root bridge considered by the switch
-    if bpdu_root_brd_id < stp['root_brd_id']:
-        stp['root_brd_id'] = bpdu_root_brd_id
-        stp['root_pth_cost'] = bpdu_root_pth_cost + 10
-        stp['root_intrf'] = recv_intrf
-
-        if was_root:
-            for i in intrfs:
-                # All trunk interfaces different from recv are set to blocking
-                i_name = get_interface_name(i)
-                if vlan_table[i_name] == 'T' and i != recv_intrf:
-                    intrfs_sts[i_name] = "blocking"
-        
-        # The recv interface is set to listening 
-        if intrfs_sts[recv_name] == "blocking":
-            intrfs_sts[recv_name] = "listening"
-
-        bpdu, bpdu_length = create_bpdu(stp)
-        
-        for i in intrfs:
-            # A new bpdu is sent on all the other interfaces
-            i_name = get_interface_name(i)
-            if vlan_table[i_name] == 'T' and i != recv_intrf:
-                if intrfs_sts[i_name] != "blocking":
-                    send_to_link(i, bpdu_length, bpdu)
-    
-    # The assumed root bridge considered by the bpdu frame is similar
-    # to the one considered by the switch
-    elif bpdu_root_brd_id == stp['root_brd_id']:
-        if recv_intrf == stp['root_intrf']:
-            if bpdu_root_pth_cost + 10 < stp['root_pth_cost']:
-                stp['root_pth_cost'] = bpdu_root_pth_cost + 10
-
-        # If the path cost is better, this interface is a designated one 
-        elif recv_intrf != stp['root_intrf']:
-            if bpdu_root_pth_cost > stp['root_pth_cost']:
-                if intrfs_sts[recv_name] != "listening":
-                    intrfs_sts[recv_name] = "listening"
-
-    elif bpdu_own_brd_id == stp['own_brd_id']:
-        intrfs_sts[recv_name] = "blocking"
-
-    if stp['own_brd_id'] == stp['root_brd_id']:
-        for i in intrfs:
-            intrfs_sts[get_interface_name(i)] = "listening"
+# A slot of the level 0 of the timer wheel is a tick, a slot of level 1 is
+# WHEEL_SLOTS ticks, and so on
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_LEVELS = 3
+
+class Timer:
+    # A timer of a TimerWheel: callback(now, *args) runs at the given tick,
+    # and then every period ticks if period is not 0. Cancelling only marks
+    # it, the wheel drops it when it comes up
+    __slots__ = ('tick', 'period', 'callback', 'args', 'active')
+
+    def __init__(self, tick, period, callback, args):
+        self.tick = tick
+        self.period = period
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+class TimerWheel:
+    # Hierarchical timer wheel that drives all the timed work of the control
+    # plane: the stp timers of every port, the hellos, the FDB expiry and the
+    # stats. Time is cut in ticks of resolution seconds counted from origin.
+    # A timer less than WHEEL_SLOTS ticks away waits in the level 0 slot of
+    # its tick, a farther one in a coarser level, and it is moved down
+    # (cascaded) when its slot comes up. Scheduling, cancelling and running a
+    # tick cost the same whatever the number of timers (and ports), and the
+    # timers run on the tick grid, so the periodic ones do not drift
+    __slots__ = ('resolution', 'origin', 'tick', 'levels')
+
+    def __init__(self, resolution, origin):
+        self.resolution = resolution
+        self.origin = origin
+        self.tick = 0
+        self.levels = [[[] for _ in range(WHEEL_SLOTS)]
+                       for _ in range(WHEEL_LEVELS)]
+
+    def ticks(self, deadline):
+        # the first tick at or after deadline, never one that already ran
+        ticks = (deadline - self.origin) / self.resolution
+        return max(self.tick + 1, math.ceil(ticks - 1e-6))
+
+    def schedule(self, deadline, callback, *args):
+        timer = Timer(self.ticks(deadline), 0, callback, args)
+        self.insert(timer)
+        return timer
+
+    def every(self, period, callback, *args):
+        # period is rounded to whole ticks, the first run is the next tick
+        period = max(1, round(period / self.resolution))
+        timer = Timer(self.tick + 1, period, callback, args)
+        self.insert(timer)
+        return timer
+
+    def insert(self, timer):
+        # A timer farther than the last level reaches waits in its last
+        # slot and is placed again when it is cascaded
+        last = WHEEL_SLOTS ** WHEEL_LEVELS - WHEEL_SLOTS ** (WHEEL_LEVELS - 1)
+        tick = min(timer.tick, self.tick + last)
+        delta = tick - self.tick
+
+        level = 0
+        while level < WHEEL_LEVELS - 1 and \
+                delta >= WHEEL_SLOTS << (WHEEL_BITS * level):
+            level += 1
+
+        slot = (tick >> (WHEEL_BITS * level)) & (WHEEL_SLOTS - 1)
+        self.levels[level][slot].append(timer)
+
+    def next_deadline(self):
+        return self.origin + (self.tick + 1) * self.resolution
+
+    def advance(self, now):
+        # Runs the timers of every tick up to now, in order. The coarser
+        # levels are cascaded first, at the start of their slots
+        target = math.floor((now - self.origin) / self.resolution + 1e-6)
+        while self.tick < target:
+            self.tick += 1
+            tick = self.tick
+
+            for level in range(WHEEL_LEVELS - 1, 0, -1):
+                shift = WHEEL_BITS * level
+                if tick & ((1 << shift) - 1) == 0:
+                    slot = (tick >> shift) & (WHEEL_SLOTS - 1)
+                    timers = self.levels[level][slot]
+                    self.levels[level][slot] = []
+                    for timer in timers:
+                        if timer.active:
+                            self.insert(timer)
+
+            slot = tick & (WHEEL_SLOTS - 1)
+            timers = self.levels[0][slot]
+            self.levels[0][slot] = []
+            now = self.origin + tick * self.resolution
+            for timer in timers:
+                if not timer.active:
+                    continue
+                if timer.tick > tick:
+                    self.insert(timer)
+                    continue
+
+                # a periodic timer is placed again first, its callback may
+                # cancel it
+                if timer.period:
+                    timer.tick += timer.period
+                    self.insert(timer)
+                timer.callback(now, *timer.args)
+
+# 802.1D port states, in the order a port goes through them
+PORT_STATES = ("disabled", "blocking", "listening", "learning", "forwarding")
+
+# A config BPDU, after the dest and src macs (and the vlan tag of a per-vlan
+# instance): root bridge id, root path cost, sender bridge id, sender port id
+# and flags. A bridge id is the priority << 48 | the switch mac, so two
+# switches with the same priority still compare
+BPDU = struct.Struct("!QIQHB")
+# its root bridge id and root path cost, the fields patched into the BPDU
+# templates of the ports
+BPDU_VECTOR = struct.Struct("!QI")
+
+# The flags, laid out like the 802.1w flags byte; the role of the sending
+# port takes bits 2-3
+BPDU_TC = 0x01
+BPDU_PROPOSAL = 0x02
+BPDU_LEARNING = 0x10
+BPDU_FORWARDING = 0x20
+BPDU_AGREEMENT = 0x40
+BPDU_ROLES = {"alternate": 1, "backup": 1, "root": 2, "designated": 3}
+
+# 802.1D-2004 long path costs: 20 Tb/s over the link speed, 2000 for
+# 10 Gb/s, 20000 for 1 Gb/s, which is also the cost of a trunk whose driver
+# does not report a speed
+PATH_COST_RATE = 20000000   # in Mb/s
+PATH_COST = 20000
+PORT_PRIORITY = 0x80    # high byte of every port id
+HELLO_TIME = 1          # seconds between two hellos
+STP_TICK = 0.1          # seconds of a tick of the timer wheel
+TC_TIME = 2 * HELLO_TIME  # seconds a topology change is announced for
+
+class StpPort:
+    # The spanning tree side of a trunk port, one per tree. info is the best
+    # priority vector (root, cost, bridge, port) received on it, None if none
+    # was, timer moves a listening or learning port to its next state,
+    # expires is when info is dropped if it is not received again (checked by
+    # info_timer) and tc_while until when the BPDUs sent on it carry the
+    # topology change flag. template is the BPDU sent on the port, vector the
+    # root vector patched into it
+    __slots__ = ('port', 'id', 'cost', 'role', 'state', 'info', 'timer',
+                 'expires', 'info_timer', 'tc_while', 'template', 'vector')
+
+    def __init__(self, port, cost, header, bridge_id):
+        self.port = port
+        self.id = (PORT_PRIORITY << 8) | port.idx
+        self.cost = cost
+        self.role = "designated"
+        self.state = "blocking"
+        self.info = None
+        self.timer = None
+        self.expires = None
+        self.info_timer = None
+        self.tc_while = None
+        self.template = bytearray(header + BPDU.pack(0, 0, bridge_id,
+                                                     self.id, 0))
+        self.vector = None
+
+def poll_links(ports):
+    # the carrier of the trunk interfaces, the members of the lags included
+    return {port.idx: link_up(port.idx) for port in ports
+            if port.trunk and port.members is None}
+
+class STP:
+    # 802.1D spanning tree over the trunk ports; the access ones lead to
+    # hosts, they are always forwarding and their BPDUs are ignored.
+    # Every change of a port state bumps generation, so the data path knows
+    # when to take a new snapshot of the states. vlan is set for the trees of
+    # PVST, their BPDUs carry its tag. All the timers run on wheel.
+    # A trunk that starts or stops forwarding, or a BPDU with the topology
+    # change flag on a root or designated port, is a topology change: the
+    # macs learned behind the other trunks may have moved. flushes queues the
+    # (ports, vlan) whose FDB entries must go, the data path takes them.
+    # A lag is a single stp port, up while one of its members is; its members
+    # are "forwarding" in the states while their link is up, "disabled" else
+    def __init__(self, ports, priority, mac, options, wheel, vlan=None,
+                 flushes=None):
+        self.lock = threading.Lock()
+        self.ports = ports
+        self.wheel = wheel
+        self.vlan = vlan
+        self.flushes = deque() if flushes is None else flushes
+        self.announce = []
+        self.header = BPDU_MAC + mac
+        if vlan is not None:
+            self.header += create_vlan_tag(vlan)
+        self.mac = mac
+        self.bridge_id = (priority << 48) | int.from_bytes(mac, 'big')
+        self.root_id = self.bridge_id
+        self.root_cost = 0
+        self.root_port = None
+        self.forward_delay = options['forward-delay']
+        self.max_age = options['max-age']
+        self.generation = 0
+        self.costs = options['path-costs']
+        self.links = poll_links(ports)
+        self.trunks = {port.idx: StpPort(port, self.path_cost(port),
+                                         self.header, self.bridge_id)
+                       for port in ports if port.trunk and port.lag is None}
+
+        now = time.monotonic()
+        for sp in self.trunks.values():
+            if not self.has_carrier(sp.port, self.links):
+                self.set_state(sp, "disabled", now)
+        self.update(now)
+
+        wheel.every(HELLO_TIME, self.timer, self.hello)
+
+    def path_cost(self, port):
+        # the cost configured for the port, or the one of its speed
+        cost = self.costs.get(port.name)
+        if cost is not None:
+            return cost
+
+        # a lag has the speed of all its members that are up
+        if port.members is not None:
+            speeds = [link_speed(member.idx) for member in port.members
+                      if self.links.get(member.idx)]
+            speed = sum(speeds) if speeds and all(speeds) else None
+        else:
+            speed = link_speed(port.idx)
+        return max(1, PATH_COST_RATE // speed) if speed else PATH_COST
+
+    @staticmethod
+    def has_carrier(port, links):
+        if port.members is None:
+            return links[port.idx]
+        return any(links[member.idx] for member in port.members)
+
+    def tx_link(self, port):
+        # the interface the BPDUs of a port go out of, for a lag the first of
+        # its members that is up
+        if port.members is None:
+            return port.idx
+        for member in port.members:
+            if self.links.get(member.idx):
+                return member.idx
+        return port.members[0].idx
+
+    def timer(self, now, callback, *args):
+        # the stp timers run under the lock, like the BPDUs
+        with self.lock:
+            callback(now, *args)
+            self.notify()
+
+    def schedule(self, deadline, callback, *args):
+        return self.wheel.schedule(deadline, self.timer, callback, *args)
+
+    def is_root(self):
+        return self.root_id == self.bridge_id
+
+    def set_state(self, sp, state, now):
+        # the entries of a trunk that starts forwarding were just learned,
+        # the ones of a trunk that stops are flushed with the others
+        if (state == "forwarding") != (sp.state == "forwarding"):
+            self.topology_change(now, sp if state == "forwarding" else None)
+
+        sp.state = state
+        if sp.timer is not None:
+            sp.timer.cancel()
+        sp.timer = self.schedule(now + self.forward_delay, self.forward, sp) \
+            if state in ("listening", "learning") else None
+        self.generation += 1
+
+    def forward(self, now, sp):
+        # the forward delay of a listening or learning port ran out
+        sp.timer = None
+        self.set_state(sp, PORT_STATES[PORT_STATES.index(sp.state) + 1], now)
+
+    def update(self, now):
+        # The root port is the one with the best path to the root, if any is
+        # better than this switch. On the other ports this switch is the
+        # designated one if it offers a better vector than the one received
+        # there, otherwise another switch already serves that link
+        best = (self.bridge_id, 0, self.bridge_id, 0, 0)
+        root_port = None
+        for sp in self.trunks.values():
+            if sp.info is None or sp.state == "disabled":
+                continue
+
+            root, cost, bridge, port_id = sp.info
+            vector = (root, cost + sp.cost, bridge, port_id, sp.id)
+            if bridge != self.bridge_id and vector < best:
+                best, root_port = vector, sp
+
+        self.root_id, self.root_cost = best[0], best[1]
+        self.root_port = root_port.port.idx if root_port else None
+
+        for sp in self.trunks.values():
+            if sp.state == "disabled":
+                role = "disabled"
+            elif sp is root_port:
+                role = "root"
+            elif sp.info is None or (self.root_id, self.root_cost,
+                                     self.bridge_id, sp.id) < sp.info:
+                role = "designated"
+            else:
+                role = "alternate"
+            self.set_role(sp, role, now)
+
+    def set_role(self, sp, role, now):
+        # an alternate port blocks right away, a root or designated one only
+        # forwards after listening and learning for forward_delay each
+        sp.role = role
+        if role == "alternate":
+            if sp.state != "blocking":
+                self.set_state(sp, "blocking", now)
+        elif role != "disabled" and sp.state == "blocking":
+            self.set_state(sp, "listening", now)
+
+    def age_info(self, now, sp):
+        # The info of a port that stopped getting BPDUs (its neighbour or
+        # the path to the root died without the link going down) is dropped
+        # and the tree recomputed without it. The timer is not moved for
+        # every BPDU, it checks expires when it runs and waits again if it
+        # was refreshed
+        if sp.expires is not None and now < sp.expires:
+            sp.info_timer = self.schedule(sp.expires, self.age_info, sp)
+            return
+
+        sp.info_timer = None
+        if sp.info is None:
+            return
+
+        sp.info = sp.expires = None
+        self.update(now)
+        self.send(self.designated())
+
+    def end_tc(self, now, sp):
+        sp.tc_while = None
+
+    def topology_change(self, now, origin=None):
+        # The entries of the trunks but origin (where the change came from)
+        # are flushed and the change is announced on them, right away and
+        # then with every BPDU sent there for TC_TIME. A port that already
+        # announces one is not sent another BPDU, or two switches would
+        # bounce the change between them
+        self.flushes.append((tuple(idx for idx, sp in self.trunks.items()
+                                   if sp is not origin), self.vlan))
+        for sp in self.trunks.values():
+            if sp is not origin and sp.tc_while is None:
+                sp.tc_while = now + TC_TIME
+                self.schedule(sp.tc_while, self.end_tc, sp)
+                self.announce.append(sp)
+
+    def tc_ports(self):
+        # the ports the topology change is announced on, upstream on the root
+        # port (towards the root, which announces it to all the tree) and
+        # downstream on the designated ones
+        return [sp for sp in self.trunks.values() if sp.tc_while is not None
+                and sp.role in ("root", "designated")]
+
+    def notify(self):
+        # the roles are final by now, the new announces go to the tree ports
+        if self.announce:
+            self.send([sp for sp in self.announce
+                       if sp.role in ("root", "designated")])
+            self.announce = []
+
+    def receive(self, recv_intrf, data, vlan_id, now):
+        # the single tree only takes the untagged BPDUs, a tree of PVST the
+        # ones tagged with its vlan
+        if vlan_id != (-1 if self.vlan is None else self.vlan):
+            return
+
+        sp = self.trunks.get(recv_intrf)
+        if sp is None or sp.state == "disabled":
+            return
+
+        # a frame too short for a BPDU is dropped, not parsed
+        if len(data) < len(self.header) + BPDU.size:
+            return
+
+        root, cost, bridge, port_id, flags = \
+            BPDU.unpack_from(data, len(self.header))
+
+        with self.lock:
+            sp.expires = now + self.max_age
+            if sp.info_timer is None:
+                sp.info_timer = self.schedule(sp.expires, self.age_info, sp)
+            self.process(sp, (root, cost, bridge, port_id), flags, now)
+
+            # an alternate port does not take part in the tree, nothing it
+            # receives is relayed
+            if flags & BPDU_TC and sp.role in ("root", "designated"):
+                self.topology_change(now, sp)
+            self.notify()
+
+    def process(self, sp, info, flags, now):
+        # a better vector, or news from the switch that sent the last one
+        if sp.info is None or info < sp.info or info[2:] == sp.info[2:]:
+            sp.info = info
+        old_root = (self.root_id, self.root_cost, self.root_port)
+        self.update(now)
+
+        # The root's hellos are relayed on the designated ports and a switch
+        # that is not designated for the link, yet sent a worse vector, is
+        # answered right away
+        if sp.port.idx == self.root_port or \
+           old_root != (self.root_id, self.root_cost, self.root_port):
+            self.send(self.designated())
+        elif sp.role == "designated":
+            self.send([sp])
+
+    def set_link(self, sp, up, now):
+        # a trunk without carrier is disabled and forgets what it received,
+        # a trunk whose link comes back may have negotiated another speed
+        sp.info = sp.expires = None
+        if up:
+            sp.cost = self.path_cost(sp.port)
+        self.set_state(sp, "blocking" if up else "disabled", now)
+        self.update(now)
+        self.send(self.designated())
+
+    def check_links(self, now, links=None):
+        # Notices the trunks whose link went up or down, on a link event.
+        # links maps the trunks to their carrier, if they were already polled
+        if links is None:
+            links = poll_links(self.ports)
+
+        with self.lock:
+            # a member of a lag leaves (or joins) its egress right away,
+            # whether or not the lag as a whole changes
+            if links != self.links:
+                self.links = links
+                self.generation += 1
+
+            for sp in self.trunks.values():
+                up = self.has_carrier(sp.port, links)
+                if up != (sp.state != "disabled"):
+                    self.set_link(sp, up, now)
+            self.notify()
+
+    def hello(self, now):
+        # runs every HELLO_TIME; only the root bridge sends hellos, the
+        # others relay them and repeat the topology changes they announce
+        if self.is_root():
+            self.send(self.designated())
+        else:
+            self.send(self.tc_ports())
+
+    def designated(self):
+        return [sp for sp in self.trunks.values() if sp.role == "designated"]
+
+    def bpdu(self, sp, flags=0):
+        # Only the root vector and the flags change from one BPDU of a port
+        # to the next, they are patched into its template
+        if sp.tc_while is not None:
+            flags |= BPDU_TC
+
+        vector = (self.root_id, self.root_cost)
+        if vector != sp.vector:
+            sp.vector = vector
+            BPDU_VECTOR.pack_into(sp.template, len(self.header), *vector)
+        sp.template[-1] = flags
+
+        return sp.template
+
+    def send(self, stp_ports, flags=0):
+        for sp in stp_ports:
+            bpdu = self.bpdu(sp, flags)
+            send_to_link(self.tx_link(sp.port), len(bpdu), bpdu)
+
+    def states(self):
+        # the state of every port, the access ones always forward
+        return tuple(self.port_state(port) for port in self.ports)
+
+    def port_state(self, port):
+        if not port.trunk:
+            return "forwarding"
+        if port.lag is not None:
+            return "forwarding" if self.links.get(port.idx) else "disabled"
+        return self.trunks[port.idx].state
+
+    def snapshot(self):
+        # the port states of every tree, by vlan; None is the tree of all
+        return {None: self.states()}
+
+    def __str__(self):
+        vlan = "" if self.vlan is None else f"vlan {self.vlan} "
+        lines = [f"{vlan}root {self.root_id:016x} cost {self.root_cost} "
+                 f"port {self.root_port}"]
+        for sp in self.trunks.values():
+            lines.append(f"  {sp.port.name}: {sp.role} {sp.state} "
+                         f"cost {sp.cost}")
+
+        return '\n'.join(lines)
+
+class RSTP(STP):
+    # 802.1w rapid spanning tree, same vectors and roles plus backup (a port
+    # that hears this switch itself). Every switch sends hellos, so the info
+    # of a dead neighbour ages out after max-age, and a port whose role
+    # allows it forwards without waiting for the forward delay:
+    # - a new root port forwards at once, the old one is already blocked;
+    # - a designated port that does not forward sends proposals; the switch
+    #   on the other side blocks its own designated ports (sync), answers
+    #   with an agreement and the port forwards when the agreement arrives.
+    #   Without one it falls back to the forward delay timers.
+    # The access ports are edge ports: they forward and never sync.
+    def set_role(self, sp, role, now):
+        if role == "alternate" and sp.info[2] == self.bridge_id:
+            role = "backup"
+
+        sp.role = role
+        if role in ("alternate", "backup"):
+            if sp.state != "blocking":
+                self.set_state(sp, "blocking", now)
+        elif role == "root":
+            if sp.state != "forwarding":
+                self.set_state(sp, "forwarding", now)
+        elif role == "designated" and sp.state == "blocking":
+            self.set_state(sp, "listening", now)
+
+    def process(self, sp, info, flags, now):
+        if sp.info is None or info < sp.info or info[2:] == sp.info[2:]:
+            sp.info = info
+        old_root = (self.root_id, self.root_cost, self.root_port)
+        self.update(now)
+
+        # the other switch is synced below this designated port
+        if flags & BPDU_AGREEMENT and sp.role == "designated" and \
+           info[0] == self.root_id and sp.state != "forwarding":
+            self.set_state(sp, "forwarding", now)
+
+        if old_root != (self.root_id, self.root_cost, self.root_port):
+            self.send(self.designated())
+
+        # A proposal on the root port blocks the designated ports below it,
+        # which then propose in turn. Alternate and backup ports already
+        # block, they agree right away
+        if flags & BPDU_PROPOSAL and sp.role != "designated":
+            if sp.role == "root":
+                self.sync(now)
+            self.send([sp], BPDU_AGREEMENT)
+        elif sp.role == "designated" and (self.root_id, self.root_cost,
+                                          self.bridge_id, sp.id) < info:
+            self.send([sp])
+
+    def sync(self, now):
+        synced = [sp for sp in self.designated()
+                  if sp.state != "listening"]
+        for sp in synced:
+            self.set_state(sp, "listening", now)
+
+        self.send(synced)
+
+    def hello(self, now):
+        root = [sp for sp in self.tc_ports() if sp.role == "root"]
+        self.send(self.designated() + root)
+
+    def bpdu(self, sp, flags=0):
+        # the designated ports that do not forward yet propose
+        flags |= BPDU_ROLES.get(sp.role, 0) << 2
+        if sp.state == "learning":
+            flags |= BPDU_LEARNING
+        elif sp.state == "forwarding":
+            flags |= BPDU_LEARNING | BPDU_FORWARDING
+        if sp.role == "designated" and sp.state != "forwarding":
+            flags |= BPDU_PROPOSAL
+
+        return super().bpdu(sp, flags)
+
+class PVST:
+    # Per-vlan spanning tree: an independent STP (or RSTP) for every vlan,
+    # with its own root, roles and port states, so the vlans can use
+    # different trunks. The trees of the local vlans and of the ones with a
+    # configured priority start right away, the other ones when a BPDU
+    # tagged with their vlan arrives. instances is replaced, never modified,
+    # so the data path can go through it while a tree is added
+    def __init__(self, ports, priority, mac, options, wheel):
+        self.lock = threading.Lock()
+        self.ports = ports
+        self.wheel = wheel
+        self.priority = priority
+        self.mac = mac
+        self.options = options
+        self.tree = RSTP if options['rstp'] else STP
+        self.flushes = deque()
+        self.instances = {}
+
+        vlans = {port.vlan for port in ports if not port.trunk}
+        for vlan in sorted(vlans | set(options['stp-priorities'])):
+            self.add(vlan)
+
+    def add(self, vlan):
+        priority = self.options['stp-priorities'].get(vlan, self.priority)
+        tree = self.tree(self.ports, priority, self.mac, self.options,
+                         self.wheel, vlan, self.flushes)
+        self.instances = {**self.instances, vlan: tree}
+        return tree
+
+    @property
+    def generation(self):
+        # a new tree changes it too, even before any of its ports moved
+        return sum(tree.generation for tree in self.instances.values()) + \
+            len(self.instances)
+
+    def receive(self, recv_intrf, data, vlan_id, now):
+        if vlan_id == -1 or not self.ports[recv_intrf].trunk:
+            return
+
+        tree = self.instances.get(vlan_id)
+        if tree is None:
+            with self.lock:
+                tree = self.instances.get(vlan_id) or self.add(vlan_id)
+
+        tree.receive(recv_intrf, data, vlan_id, now)
+
+    def check_links(self, now):
+        # the carrier of the trunks is polled once for all the trees
+        links = poll_links(self.ports)
+        for tree in self.instances.values():
+            tree.check_links(now, links)
+
+    def snapshot(self):
+        return {vlan: tree.states() for vlan, tree in self.instances.items()}
+
+    def __str__(self):
+        return '\n'.join(str(tree) for _, tree in
+                         sorted(self.instances.items()))
+
+IP_IGMP = 2
+IP_PIM = 103
+IGMP_QUERY = 0x11
+IGMP_V1_REPORT = 0x12
+IGMP_V2_REPORT = 0x16
+IGMP_V3_REPORT = 0x22
+IGMP_LEAVE = 0x17
+# the v3 group records that only list sources to receive from, an empty
+# list is a leave
+IGMP_INCLUDE = (1, 3, 5)
+IGMP_BLOCK = 6
+ALL_PIM_ROUTERS = 0xE000000D    # 224.0.0.13
+# 01:00:5e:00:00:00 - 01:00:5e:7f:ff:ff carry the IPv4 multicast groups
+IPV4_MULTICAST_MAC = b"\x01\x00\x5e"
+# seconds a port stays in a group it left, for the querier to ask whether
+# other hosts behind it are still in it
+IGMP_LEAVE_TIME = 2
+IGMP_MAX_GROUPS = 4096
+
+def payload_start(data):
+    # where the payload (IPv4, ARP) of an ethernet frame starts, after its
+    # vlan tag if it has one
+    return 18 if data[12:14] == b"\x82\x00" else 14
+
+def igmp_messages(data):
+    # The (kind, group) pairs an IGMP message or a PIM hello says: "router"
+    # for a query or a hello, "join" or "leave" of group for a report or a
+    # leave; a v3 report has a record per group
+    ip = payload_start(data)
+    if len(data) < ip + 20:
+        return []
+    igmp = ip + (data[ip] & 0x0F) * 4
+    if len(data) < igmp + 8:
+        return []
+    if data[ip + 9] == IP_PIM or data[igmp] == IGMP_QUERY:
+        return [("router", None)]
+
+    kind = data[igmp]
+    if kind in (IGMP_V1_REPORT, IGMP_V2_REPORT, IGMP_LEAVE):
+        group = int.from_bytes(data[igmp + 4:igmp + 8], 'big')
+        return [("leave" if kind == IGMP_LEAVE else "join", group)]
+
+    messages = []
+    if kind == IGMP_V3_REPORT:
+        count = int.from_bytes(data[igmp + 6:igmp + 8], 'big')
+        pos = igmp + 8
+        # a record cut by CONTROL_FRAME ends the list
+        for _ in range(count):
+            if pos + 8 > len(data):
+                break
+            record, aux, sources = data[pos], data[pos + 1], \
+                int.from_bytes(data[pos + 2:pos + 4], 'big')
+            group = int.from_bytes(data[pos + 4:pos + 8], 'big')
+            if record != IGMP_BLOCK:
+                leave = record in IGMP_INCLUDE and not sources
+                messages.append(("leave" if leave else "join", group))
+            pos += 8 + 4 * sources + 4 * aux
+
+    return messages
+
+class Snooping:
+    # IGMP snooping (v1, v2 and v3, by group, not by source), run by the
+    # control plane next to the stp. The data path hands it the IGMP
+    # messages and the PIM hellos it receives. members maps (vlan, group) to
+    # the ports that reported it and routers maps a vlan to the ports the
+    # queries (or hellos) come from, each port with the second it expires
+    # in. A leave only shortens it to IGMP_LEAVE_TIME, the time for the
+    # querier to ask whether other hosts behind the port are still in the
+    # group. generation changes with the port sets, not with the timeouts
+    def __init__(self, ports, options, wheel):
+        self.ports = ports
+        self.timeout = options['igmp-timeout']
+        self.members = {}
+        self.routers = {}
+        self.generation = 0
+        wheel.every(1, self.expire)
+
+    def receive(self, recv_intrf, data, now):
+        port = self.ports[recv_intrf]
+        vlan_id = parse_ethernet_header(data)[3]
+        vlan = vlan_id if port.trunk else port.vlan
+        expires = now + self.timeout
+
+        for kind, group in igmp_messages(data):
+            if kind == "router":
+                self.add(self.routers, vlan, recv_intrf, expires)
+            elif kind == "join":
+                if (vlan, group) in self.members or \
+                        len(self.members) < IGMP_MAX_GROUPS:
+                    self.add(self.members, (vlan, group), recv_intrf, expires)
+            else:
+                ports = self.members.get((vlan, group), {})
+                if recv_intrf in ports:
+                    ports[recv_intrf] = min(ports[recv_intrf],
+                                            now + IGMP_LEAVE_TIME)
+
+    def add(self, table, key, port, expires):
+        ports = table.setdefault(key, {})
+        if port not in ports:
+            self.generation += 1
+        ports[port] = expires
+
+    def expire(self, now):
+        # runs every second
+        for table in (self.members, self.routers):
+            for key, ports in list(table.items()):
+                for port, expires in list(ports.items()):
+                    if expires <= now:
+                        del ports[port]
+                        self.generation += 1
+                if not ports:
+                    del table[key]
+
+    def snapshot(self):
+        # the ports of every group and the router ports of every vlan
+        return ({key: tuple(ports) for key, ports in self.members.items()},
+                {vlan: tuple(ports) for vlan, ports in self.routers.items()})
+
+    def __str__(self):
+        lines = ["igmp snooping"]
+        for vlan, ports in sorted(self.routers.items()):
+            names = ' '.join(self.ports[port].name for port in ports)
+            lines.append(f"  vlan {vlan} routers: {names}")
+        for (vlan, group), ports in sorted(self.members.items()):
+            names = ' '.join(self.ports[port].name for port in ports)
+            address = '.'.join(str(byte) for byte in group.to_bytes(4, 'big'))
+            lines.append(f"  vlan {vlan} {address}: {names}")
+
+        return '\n'.join(lines)
 
 def is_unicast(mac):
-    # Checks if the most significant byte is even
-    return int(mac.split(":")[0], 16) % 2 == 0 
+    # Checks if the group bit of the first byte is clear
+    return not mac[0] & 1
 
 def is_bpdu(mac):
     # Checks if the dest mac address identifies as a bpdu frame 
-    return mac == "01:80:c2:00:00:00"
+    return mac == BPDU_MAC
 
 def create_vlan_tag(vlan_id):
     # 0x8100 for the Ethertype for 802.1Q
     # vlan_id & 0x0FFF ensures that only the last 12 bits are used
     return struct.pack('!H', 0x8200) + struct.pack('!H', vlan_id & 0x0FFF)
 
-def add_vlan_tag(length, data, vlan_id):
-    return length + 4, data[0:12] + create_vlan_tag(vlan_id) + data[12:]
+# The frames are rewritten in place in their receive buffer, start is where
+# the frame begins. Adding a tag moves the macs 4 bytes back (into the
+# headroom for a received frame) and writes the tag after them, removing it
+# moves the macs 4 bytes forward over the tag. Returns the new start, length
+def add_vlan_tag(buf, start, length, tag):
+    buf[start - 4:start + 8] = buf[start:start + 12]
+    buf[start + 8:start + 12] = tag
+    return start - 4, length + 4
 
-def remove_vlan_tag(length, data):
-    return length - 4, data[0:12] + data[16:]
+def remove_vlan_tag(buf, start, length):
+    buf[start + 4:start + 16] = buf[start:start + 12]
+    return start + 4, length - 4
 
-def create_bpdu(stp): 
-    # In the bpdu data there are stored the following fields:
-    # dest_mac, src_mac, own_brd_id, root_brd_id and root_pth_cost
-    bpdu_data = struct.pack("!6s6sIII", b"\x01\x80\xC2\x00\x00\x00",
-                            get_switch_mac(), stp['own_brd_id'],
-                            stp['root_brd_id'], stp['root_pth_cost'])
-    
-    return bpdu_data, len(bpdu_data)
+def flow_member(buf, members, vlan):
+    # The member of a lag a frame goes out of: the same for all the frames
+    # between two macs in a vlan, so that a flow keeps its order
+    return members[crc32(buf[HEADROOM:HEADROOM + 12], vlan) % len(members)]
 
-def send_bpdu_every_sec(stp, intrfs, vlan_table):
-    while True:
-        # If the switch is the root bridge, it sends
-        # every 1 sec a bpdu on all trunk ports  
-        if stp['own_brd_id'] == stp['root_brd_id']:
-            bpdu, length = create_bpdu(stp)
+def forward_frame(dest_intrf, buf, length, vlan_id, egress):
+    tagged = egress.members.get(dest_intrf)
 
-            for i in intrfs:
-                if vlan_table[get_interface_name(i)] == 'T':
-                    send_to_link(i, length, bpdu)
+    # dest_intrf is in another vlan, blocked or the recv interface
+    if tagged is None:
+        return
 
-        time.sleep(1)
+    if egress.lags and dest_intrf in egress.lags:
+        dest_intrf = flow_member(buf, egress.lags[dest_intrf], egress.vlan)
 
-def forward_frame(dest_intrf, length, data, vlan_id, vlan_table, recv_intrf,
-                  intrfs_sts):
-    recv_name = get_interface_name(recv_intrf)
-    dest_name = get_interface_name(dest_intrf)
+    start = HEADROOM
 
-    # recv_intrf and dest_intrf are both access
-    if vlan_id == -1 and vlan_table[dest_name] != 'T':
-        if vlan_table[recv_name] != vlan_table[dest_name]:
-            return
-    
     # recv_intrf is access and dest_intrf is trunk
-    if vlan_id == -1 and vlan_table[dest_name] == 'T':
-        if intrfs_sts[dest_name] == "blocking":
-            return
-        length, data = add_vlan_tag(length, data, vlan_table[recv_name])
+    if tagged and vlan_id == -1:
+        start, length = add_vlan_tag(buf, start, length, egress.tag)
 
     # recv_intrf is trunk and dest_intrf is access
-    if vlan_id != -1 and vlan_table[dest_name] != 'T':
-        if vlan_id != vlan_table[dest_name]:
+    elif not tagged and vlan_id != -1:
+        start, length = remove_vlan_tag(buf, start, length)
+
+    send_to_link(dest_intrf, length, buf[start:start + length])
+
+def flood_frame(buf, length, vlan_id, egress):
+    # A single call into dlink sends the frame as it arrived to the ports
+    # that take it that way, tagged (trunk) or untagged (access), and the
+    # other representation, which dlink gathers from the frame and the tag of
+    # the vlan, to the others; the frame is not rewritten. The lags take the
+    # tagged frame, on the member of its flow
+    tagged = egress.c_tagged
+    if egress.lags:
+        tagged = port_array(egress.tagged +
+                            [flow_member(buf, members, egress.vlan)
+                             for members in egress.lags.values()])
+    if tagged or egress.c_untagged:
+        send_to_many(egress.c_untagged, tagged, length,
+                     buf[HEADROOM:HEADROOM + length], vlan_id != -1,
+                     egress.tag)
+
+# A frame handed by the data path to the control plane (a BPDU, or an IGMP or
+# PIM message for the snooping): the interface it came from, its length and
+# up to CONTROL_FRAME bytes of it. Written to a pipe in one piece, the control
+# plane reads up to CONTROL_BATCH of them at once
+CONTROL_FRAME = 256
+CONTROL_RECORD = struct.Struct(f"!iH{CONTROL_FRAME}s")
+CONTROL_BATCH = 64
+
+class SharedSnapshot:
+    # A snapshot of the control plane for the multi-process mode, published
+    # by the control process in shared memory: a generation number and the
+    # length of the snapshot, then the snapshot itself, pickled (after
+    # encode). The generation is odd while it is written, the workers reload
+    # the snapshot when the generation changed and was the same before and
+    # after the read
+    __slots__ = ('mem', 'generation')
+
+    HEADER = struct.Struct("=II")
+
+    def __init__(self, size):
+        self.mem = mmap.mmap(-1, self.HEADER.size + size)
+        self.generation = 0
+
+    def encode(self, snapshot):
+        return snapshot
+
+    def decode(self, snapshot):
+        return snapshot
+
+    def publish(self, snapshot):
+        data = pickle.dumps(self.encode(snapshot))
+
+        self.HEADER.pack_into(self.mem, 0, self.generation + 1, 0)
+        self.mem[self.HEADER.size:self.HEADER.size + len(data)] = data
+        self.generation += 2
+        self.HEADER.pack_into(self.mem, 0, self.generation, len(data))
+
+    def load(self):
+        # Returns the new snapshot, None if there is none (or it is being
+        # written, then the next call gets it)
+        generation, length = self.HEADER.unpack_from(self.mem)
+        if generation == self.generation or generation & 1:
+            return None
+
+        data = self.mem[self.HEADER.size:self.HEADER.size + length]
+        if self.HEADER.unpack_from(self.mem)[0] != generation:
+            return None
+
+        self.generation = generation
+        return self.decode(pickle.loads(data))
+
+class PortStates(SharedSnapshot):
+    # The stp snapshot, with one byte per port (its index in PORT_STATES)
+    # for every tree
+    __slots__ = ()
+
+    def __init__(self, num_ports):
+        # room for a tree per vlan
+        super().__init__(4096 * (num_ports + 16))
+
+    def encode(self, trees):
+        return {vlan: bytes(PORT_STATES.index(state) for state in states)
+                for vlan, states in trees.items()}
+
+    def decode(self, trees):
+        return {vlan: tuple(PORT_STATES[state] for state in states)
+                for vlan, states in trees.items()}
+
+# The classes of flooded frames storm control limits, by destination mac
+STORM_CLASSES = ('broadcast', 'multicast', 'unknown-unicast')
+BROADCAST_MAC = b"\xff" * 6
+
+def storm_class(mac):
+    if mac == BROADCAST_MAC:
+        return 0
+    return 1 if mac[0] & 1 else 2
+
+class TokenBucket:
+    # rate frames per second, up to burst at once. The tokens are refilled
+    # from the time since the last frame when one arrives, with no timer.
+    # counter is where the frames it drops are counted
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'counter')
+
+    def __init__(self, rate, burst, counter):
+        self.counter = counter
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+
+        self.tokens = tokens - 1
+        return True
+
+class StormControl:
+    # Limits, per ingress interface and per class, the frames that get
+    # flooded: policers maps an interface to a TokenBucket per class (None
+    # for an unlimited one), the frames over the rate are dropped. The drops
+    # are counted in shared memory, one counter per (interface, class),
+    # written only by the data path that receives on the interface (the
+    # workers split them) and read by the control plane. With errdisable, an
+    # interface that keeps dropping for that many seconds in a row is set
+    # down (err-disabled), so the neighbour sees its link go down too, and
+    # back up after recovery seconds
+    def __init__(self, ports, options, wheel):
+        self.ports = ports
+        self.wheel = wheel
+        self.errdisable = options['storm-errdisable']
+        self.recovery = options['storm-recovery']
+        self.mem = mmap.mmap(-1, 8 * len(ports) * len(STORM_CLASSES))
+        self.drops = memoryview(self.mem).cast('Q')
+        self.policers = {}
+        self.seen = {}
+        self.over = {}
+        self.disabled = set()
+
+        for port in physical_ports(ports):
+            limits = options['storm-control'].get(port.name)
+            if not limits:
+                continue
+            for name in limits:
+                if name not in STORM_CLASSES:
+                    raise ValueError(f"unknown storm control class {name}")
+            start = port.idx * len(STORM_CLASSES)
+            self.policers[port.idx] = tuple(
+                TokenBucket(*limits[name], start + cls) if name in limits
+                else None for cls, name in enumerate(STORM_CLASSES))
+
+        if self.errdisable and self.policers:
+            wheel.every(1, self.check)
+
+    def admit(self, policers, mac):
+        # policers are the ones of the ingress interface
+        bucket = policers[storm_class(mac)]
+        if bucket is None or bucket.take(time.monotonic()):
+            return True
+
+        self.drops[bucket.counter] += 1
+        return False
+
+    def port_drops(self, idx):
+        start = idx * len(STORM_CLASSES)
+        return sum(self.drops[start:start + len(STORM_CLASSES)])
+
+    def check(self, now):
+        # runs every second in the control plane
+        for idx in self.policers:
+            if idx in self.disabled:
+                continue
+
+            drops = self.port_drops(idx)
+            self.over[idx] = self.over.get(idx, 0) + 1 \
+                if drops != self.seen.get(idx, 0) else 0
+            self.seen[idx] = drops
+
+            if self.over[idx] >= self.errdisable:
+                self.shut(idx, now)
+
+    def shut(self, idx, now):
+        name = self.ports[idx].name
+        if not set_link_up(idx, False):
+            print(f"STORM: can not shut {name}", flush=True)
             return
-        length, data = remove_vlan_tag(length, data)
 
-    # recv_intrf and dest_intrf are both trunk
-    if vlan_id != -1 and vlan_table[dest_name] == 'T':
-        if intrfs_sts[dest_name] == "blocking":
+        self.disabled.add(idx)
+        print(f"STORM: {name} err-disabled after {self.errdisable}s of "
+              f"storm drops", flush=True)
+        if self.recovery:
+            self.wheel.schedule(now + self.recovery, self.recover, idx)
+
+    def recover(self, now, idx):
+        set_link_up(idx, True)
+        self.disabled.discard(idx)
+        self.over[idx] = 0
+        self.seen[idx] = self.port_drops(idx)
+        print(f"STORM: {self.ports[idx].name} recovered", flush=True)
+
+    def __str__(self):
+        lines = ["storm control drops"]
+        for idx in self.policers:
+            start = idx * len(STORM_CLASSES)
+            counts = ' '.join(f"{name} {self.drops[start + cls]}"
+                              for cls, name in enumerate(STORM_CLASSES))
+            state = " err-disabled" if idx in self.disabled else ""
+            lines.append(f"  {self.ports[idx].name}: {counts}{state}")
+
+        return '\n'.join(lines)
+
+def dump_state(fdb, stp, storm=None, snooping=None, arp=None):
+    # SIGUSR1 prints the spanning tree, the forwarding database, the storm
+    # control counters, the IGMP snooping table and the ARP cache
+    def handler(signum, frame):
+        print(stp, fdb, sep='\n', flush=True)
+        for table in (storm, snooping, arp):
+            if table is not None:
+                print(table, flush=True)
+
+    signal.signal(signal.SIGUSR1, handler)
+
+class Switch:
+    # Everything the data path needs, shared by all the receive loops,
+    # but the stp, which belongs to the control plane: the BPDUs are handed
+    # to it through control_pipe and it publishes the port states back. Without
+    # a pipe (asyncio) the stp runs on the data path thread. storm polices
+    # the flooded frames of the interfaces it has limits for. With IGMP
+    # snooping, the control plane also gets the IGMP messages and publishes
+    # the group members and router ports back, snooping is its table when it
+    # runs on the data path thread. arp is the ARP suppression cache
+    def __init__(self, ports, stp, options, fdb=None, control_pipe=None,
+                 storm=None, snooping=None):
+        self.ports = ports
+        self.stp = stp
+        self.options = options
+        self.plan = EgressPlan(ports)
+        self.generation = None
+        self.trees = stp.snapshot() if stp is not None else None
+        self.fdb = fdb if fdb is not None else FDB(options)
+        self.control_pipe = control_pipe
+        self.storm = storm
+        self.policers = storm.policers if storm is not None else {}
+        self.snooping = snooping
+        self.snooping_on = options['igmp-snooping']
+        self.groups = snooping.snapshot() if snooping is not None else ({}, {})
+        self.groups_generation = None
+        self.group_view = None
+        self.group_egress = {}
+        self.arp = ArpCache(options) if options['arp-suppression'] else None
+        self.received = 0
+
+    def handle_frame(self, recv_intrf, buf, length, now):
+        # the frame starts at HEADROOM in its receive buffer
+        data = buf[HEADROOM:HEADROOM + length]
+        dest_mac, src_mac, ethertype, vlan_id = parse_ethernet_header(data)
+
+        # the frames of a member of a lag, BPDUs included, come from the lag;
+        # storm control polices the interface
+        recv_port = self.ports[recv_intrf]
+        policers = self.policers.get(recv_intrf)
+        if recv_port.lag is not None:
+            recv_port = recv_port.lag
+            recv_intrf = recv_port.idx
+
+        if is_bpdu(dest_mac):
+            self.hand_over(recv_intrf, data)
             return
 
-    send_to_link(dest_intrf, length, data)
+        # access frames belong to the vlan of the port, trunk ones carry it
+        vlan = vlan_id if recv_port.trunk else recv_port.vlan
+
+        egress = self.plan.lookup(recv_intrf, vlan)
+        if egress is None:
+            return
+
+        # Data frames are dropped on the ports that do not forward in the
+        # tree of their vlan, before any other work; the learning ones only
+        # learn their source
+        state = egress.ingress
+        if state != "forwarding" and state != "learning":
+            return
+
+        self.fdb.learn(vlan, src_mac, recv_intrf, now)
+        if state == "learning":
+            return
+
+        if self.arp is not None and ethertype == 0x0806 and \
+                self.suppress_arp(recv_port, buf, data, vlan, vlan_id, egress,
+                                  now):
+            return
+
+        dest_intrf = self.fdb.lookup(vlan, dest_mac) if is_unicast(dest_mac) \
+            else None
+
+        if dest_intrf is not None:
+            forward_frame(dest_intrf, buf, length, vlan_id, egress)
+
+        else: # is broadcast or unknown unicast
+            if policers is not None and \
+                    not self.storm.admit(policers, dest_mac):
+                return
+            if self.snooping_on and ethertype == 0x0800 and \
+                    dest_mac[:3] == IPV4_MULTICAST_MAC:
+                egress = self.snoop(recv_intrf, data, vlan, egress)
+            flood_frame(buf, length, vlan_id, egress)
+
+    def suppress_arp(self, recv_port, buf, data, vlan, vlan_id, egress, now):
+        # Learns the bindings of the ARP replies and gratuitous ARPs. A
+        # broadcast request for a known address is answered right away on an
+        # access port, or only sent on towards the port of its mac (from
+        # another switch). Returns True if the frame was handled; the others,
+        # including the probes (sender 0.0.0.0), go on as usual
+        arp = payload_start(data)
+        if len(data) < arp + 28 or data[arp:arp + 6] != ARP_ETHER_IPV4:
+            return False
+
+        op = data[arp + 7]
+        sender_ip = bytes(data[arp + 14:arp + 18])
+        target_ip = bytes(data[arp + 24:arp + 28])
+        if op == ARP_REPLY or (op == ARP_REQUEST and sender_ip == target_ip):
+            self.arp.learn(vlan, sender_ip, bytes(data[arp + 8:arp + 14]), now)
+            return False
+
+        if op != ARP_REQUEST or data[0:6] != BROADCAST_MAC or \
+                sender_ip == bytes(4):
+            return False
+
+        mac = self.arp.lookup(vlan, target_ip, now)
+        if mac is None:
+            return False
+
+        if not recv_port.trunk:
+            reply = arp_reply(bytes(data[arp + 8:arp + 14]), sender_ip, mac,
+                              target_ip)
+            send_to_link(recv_port.idx, len(reply), reply)
+            return True
+
+        dest_intrf = self.fdb.lookup(vlan, mac)
+        if dest_intrf is None:
+            return False
+
+        buf[HEADROOM:HEADROOM + 6] = mac
+        forward_frame(dest_intrf, buf, len(data), vlan_id, egress)
+        return True
+
+    def snoop(self, recv_intrf, data, vlan, egress):
+        # The egress of an IPv4 multicast frame with IGMP snooping. The IGMP
+        # messages (and PIM hellos) go to the control plane too; the queries
+        # and the link local groups (224.0.0.x) are flooded, the reports and
+        # leaves only go to the router ports and the other groups to their
+        # members and the router ports. A vlan without router ports (no
+        # querier) floods what the snooping does not know
+        ip = payload_start(data)
+        if len(data) < ip + 20:
+            return egress
+
+        proto = data[ip + 9]
+        group = int.from_bytes(data[ip + 16:ip + 20], 'big')
+        if proto == IP_IGMP or (proto == IP_PIM and group == ALL_PIM_ROUTERS):
+            self.hand_over(recv_intrf, data)
+            igmp = ip + (data[ip] & 0x0F) * 4
+            if proto == IP_PIM or \
+                    (len(data) > igmp and data[igmp] == IGMP_QUERY):
+                return egress
+            group = None
+
+        elif group & 0xFFFFFF00 == 0xE0000000:
+            return egress
+
+        key = (egress, group)
+        restricted = self.group_egress.get(key)
+        if restricted is None:
+            members, routers = self.groups
+            ports = set(routers.get(vlan, ()))
+            if group is not None:
+                ports.update(members.get((vlan, group), ()))
+
+            restricted = egress.restrict(ports) if ports else egress
+            if len(self.group_egress) >= IGMP_MAX_GROUPS:
+                self.group_egress = {}
+            self.group_egress[key] = restricted
+
+        return restricted
+
+    def hand_over(self, recv_intrf, data):
+        # a frame for the control plane, a BPDU or an IGMP message
+        if self.control_pipe is None:
+            now = time.monotonic()
+            if is_bpdu(data[0:6]):
+                self.stp.receive(recv_intrf, data,
+                                 parse_ethernet_header(data)[3], now)
+            else:
+                self.snooping.receive(recv_intrf, data, now)
+            self.update_trees()
+            return
+
+        # A full pipe means the control plane is behind, the frame is dropped
+        # rather than stalling the data path; the neighbours send it again
+        try:
+            os.write(self.control_pipe, CONTROL_RECORD.pack(
+                recv_intrf, min(len(data), CONTROL_FRAME),
+                bytes(data[:CONTROL_FRAME])))
+        except BlockingIOError:
+            pass
+
+    def publish(self, trees):
+        # Called by the control plane with every new snapshot of the port
+        # states. A snapshot is never modified once published, the data path
+        # takes it with a single reference swap, no lock
+        self.trees = trees
+
+    def publish_groups(self, groups):
+        # the same for the snapshots of the IGMP snooping
+        self.groups = groups
+
+    def update_trees(self):
+        # the stp runs on this thread (asyncio), its changes are published
+        # here, as are the ones of the snooping
+        if self.stp.generation != self.generation:
+            self.generation = self.stp.generation
+            self.publish(self.stp.snapshot())
+        snooping = self.snooping
+        if snooping is not None and \
+                snooping.generation != self.groups_generation:
+            self.groups_generation = snooping.generation
+            self.publish_groups(snooping.snapshot())
+        self.sync()
+
+    def sync(self):
+        # The forwarding plan only changes when a port state does, the loops
+        # call this once per receive and rebuild it when a new snapshot was
+        # published
+        trees = self.trees
+        if trees is not self.plan.trees:
+            self.plan.refresh(trees)
+            self.group_egress = {}
+        if self.groups is not self.group_view:
+            self.group_view = self.groups
+            self.group_egress = {}
+
+        # the FDB belongs to the data path, the flushes of the topology
+        # changes are done here
+        flushes = self.stp.flushes
+        while flushes:
+            self.fdb.flush(*flushes.popleft())
+
+    def run(self):
+        while True:
+            # buf is a reusable receive buffer, not a copy of the frame
+            recv_intrf, buf, length = recv_from_any_link()
+            if recv_intrf < 0:
+                continue
+
+            # the FDB works with a one second resolution
+            now = int(time.monotonic())
+            self.fdb.age(now)
+            self.sync()
+            self.handle_frame(recv_intrf, buf, length, now)
+
+    def run_batch(self, max_frames):
+        while True:
+            # up to max_frames frames from all the ready interfaces, each in
+            # its own receive buffer, valid until the next recv_batch call
+            frames = recv_batch(max_frames)
+
+            now = int(time.monotonic())
+            self.fdb.age(now)
+            self.sync()
+            for recv_intrf, buf, length in frames:
+                self.handle_frame(recv_intrf, buf, length, now)
+
+    def run_ring(self):
+        # A whole ring block is processed at a time. The sends of this
+        # thread are only queued in the TX rings and flushed once per block
+        defer_tx(True)
+
+        while True:
+            port, frames = recv_block()
+            if port < 0:
+                continue
+
+            now = int(time.monotonic())
+            self.fdb.age(now)
+            self.sync()
+            for recv_intrf, buf, length in frames:
+                self.handle_frame(recv_intrf, buf, length, now)
+
+            release_block(port)
+            flush_tx()
+
+    def run_async(self, max_frames, wheel):
+        asyncio.run(self.serve(max_frames, wheel))
+
+    async def serve(self, max_frames, wheel):
+        # Everything runs on the event loop thread, so the stp state has a
+        # single user: the sockets are registered with the loop and the timed
+        # work (the stp timers and hellos, aging, stats) is on the timer
+        # wheel, which a loop timer advances every tick instead of a thread.
+        # The ticks are at fixed deadlines, a late run does not shift the
+        # next ones
+        loop = asyncio.get_running_loop()
+
+        for port in physical_ports(self.ports):
+            loop.add_reader(get_interface_fd(port.idx), self.drain, port.idx,
+                            max_frames)
+
+        # a link change runs the stp right away, without link events the
+        # carrier is polled every tick
+        events = link_events_open()
+        if events is not None:
+            loop.add_reader(events, self.link_event)
+        else:
+            wheel.every(STP_TICK, self.stp.check_links)
+
+        self.every(loop, STP_TICK, self.advance, wheel)
+        wheel.every(1, self.age)
+        if self.options['stats']:
+            wheel.every(self.options['stats'], self.print_stats,
+                        self.options['stats'])
+
+        await loop.create_future()
+
+    def every(self, loop, period, callback, *args):
+        def tick(deadline):
+            callback(*args)
+
+            # deadlines missed under load are skipped, not run in a burst
+            deadline += period
+            while deadline <= loop.time():
+                deadline += period
+            loop.call_at(deadline, tick, deadline)
+
+        loop.call_soon(tick, loop.time())
+
+    def drain(self, port, max_frames):
+        # the socket is readable, the frames queued on it are taken in one
+        # call, then the loop serves the other ready sockets
+        frames = recv_link_batch(port, max_frames)
+        self.received += len(frames)
+
+        now = int(time.monotonic())
+        self.sync()
+        for recv_intrf, buf, length in frames:
+            self.handle_frame(recv_intrf, buf, length, now)
+
+    def advance(self, wheel):
+        wheel.advance(time.monotonic())
+        self.update_trees()
+
+    def link_event(self):
+        if read_link_events():
+            self.stp.check_links(time.monotonic())
+            self.update_trees()
+
+    def age(self, now):
+        # an expiration burst larger than the budget goes on in the next
+        # loop iterations, between the received frames
+        if self.fdb.age(int(now)):
+            asyncio.get_running_loop().call_soon(self.age, now)
+
+    def print_stats(self, now, period):
+        print(f"stats: {self.received / period:.0f} frames/s, "
+              f"{len(self.fdb)} FDB entries", flush=True)
+        self.received = 0
+
+class WorkerSwitch(Switch):
+    # A data path process of the multi-process mode. It receives only on its
+    # share of the ports, hands the BPDUs to the control process and forwards
+    # with the port states the control process publishes
+    def __init__(self, ports, options, fdb, states, groups, control_pipe,
+                 storm):
+        super().__init__(ports, None, options, fdb, control_pipe, storm)
+        # The fork copied the generations the control process published
+        # before it, as if they were loaded already: start from none so the
+        # first sync takes the initial port states (and groups)
+        states.generation = 0
+        groups.generation = 0
+        self.states = states
+        self.shared_groups = groups
+
+    def sync(self):
+        trees = self.states.load()
+        if trees is not None:
+            self.plan.refresh(trees)
+            self.group_egress = {}
+
+        groups = self.shared_groups.load()
+        if groups is not None:
+            self.groups = groups
+            self.group_egress = {}
+
+def run_worker(ports, options, fdb, states, groups, control_pipe, storm,
+               rx_ports):
+    # SIGUSR1 is for the control process, it prints the shared FDB
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    wrapper.init_worker([port.idx for port in rx_ports])
+
+    switch = WorkerSwitch(ports, options, fdb, states, groups, control_pipe,
+                          storm)
+    if options['batch']:
+        switch.run_batch(options['batch'])
+    else:
+        switch.run()
+
+def run_control(stp, wheel, control_pipe, publish, fdb=None, snooping=None,
+                publish_groups=None):
+    # The control plane owns the stp state: it runs the BPDUs the data path
+    # hands over, the timer wheel and the link changes (right away, or
+    # polled every tick without link events), and publishes a new snapshot
+    # of the port states when one changed. It is a thread next to the data
+    # path, which keeps its FDB, or with the workers a process that also
+    # ages the shared FDB, once a second, and does its flushes. The IGMP
+    # snooping table is kept and published the same way
+    generation = None
+    groups_generation = None
+    events = link_events_open()
+    fds = [control_pipe] if events is None else [control_pipe, events]
+    if events is None:
+        wheel.every(STP_TICK, stp.check_links)
+    if fdb is not None:
+        wheel.every(1, fdb.expire)
+
+    while True:
+        timeout = max(0, wheel.next_deadline() - time.monotonic())
+        readable, _, _ = select.select(fds, [], [], timeout)
+        if events in readable and read_link_events():
+            stp.check_links(time.monotonic())
+
+        if control_pipe in readable:
+            records = os.read(control_pipe,
+                              CONTROL_BATCH * CONTROL_RECORD.size)
+            if not records:
+                print("All the workers exited", flush=True)
+                os._exit(1)
+
+            # the records are written whole, the pipe never splits them. A
+            # frame the control plane fails on is dropped, it must not stop
+            # the timers and the link events of the others
+            now = time.monotonic()
+            for recv_intrf, length, data in \
+                    CONTROL_RECORD.iter_unpack(records):
+                data = data[:length]
+                try:
+                    if is_bpdu(data[0:6]):
+                        vlan_id = parse_ethernet_header(data)[3]
+                        stp.receive(recv_intrf, data, vlan_id, now)
+                    elif snooping is not None:
+                        snooping.receive(recv_intrf, data, now)
+                except Exception as error:
+                    print(f"CONTROL: dropped a frame from interface "
+                          f"{recv_intrf}: {error!r}", flush=True)
+
+        wheel.advance(time.monotonic())
+
+        if stp.generation != generation:
+            generation = stp.generation
+            publish(stp.snapshot())
+
+        if snooping is not None and snooping.generation != groups_generation:
+            groups_generation = snooping.generation
+            publish_groups(snooping.snapshot())
+
+        while fdb is not None and stp.flushes:
+            fdb.flush(*stp.flushes.popleft())
+
+def run_workers(ports, stp, wheel, options, workers, storm, snooping):
+    # The ingress ports are split between the worker processes, which share
+    # the FDB and all the sockets; this process becomes the control one
+    fdb = SharedFDB(options)
+    states = PortStates(len(ports))
+    states.publish(stp.snapshot())
+    # room for every group with a few ports
+    groups = SharedSnapshot(256 * IGMP_MAX_GROUPS)
+    control_read, control_write = os.pipe()
+    os.set_blocking(control_write, False)
+
+    for worker in range(workers):
+        if os.fork() == 0:
+            os.close(control_read)
+            run_worker(ports, options, fdb, states, groups, control_write,
+                       storm, physical_ports(ports)[worker::workers])
+            os._exit(0)
+
+    os.close(control_write)
+
+    dump_state(fdb, stp, storm, snooping)
+    run_control(stp, wheel, control_read, states.publish, fdb, snooping,
+                groups.publish)
 
 def main():
-    mac_table = {}
     vlan_table = {}
-    intrfs_sts = {}
+    options = {}
     
-    # init returns the max interface number. Our interfaces
-    # are 0, 1, 2, ..., init_ret value + 1
     sw_id = sys.argv[1]
-    intrfs = range(0, wrapper.init(sys.argv[2:]))
-
-    sw_priority = parse_config_file(sw_id, vlan_table)
+    sw_priority = parse_config_file(sw_id, vlan_table, options)
 
-    # all trunk ports(between switches) are set on blocking and
-    # the access ones(between a switch and a host) are set on listening
-    for i in intrfs:
-        i_name = get_interface_name(i)
+    # init returns the max interface number. Our interfaces
+    # are 0, 1, 2, ..., init_ret value + 1
+    # the rings are not shared between processes, the workers use sockets,
+    # as does the asyncio mode, which polls the sockets itself
+    ring = options['ring'] and not options['workers'] \
+        and not options['asyncio']
+    num_intrfs = wrapper.init(sys.argv[2:], IO_RING if ring else IO_SOCKET)
 
-        intrfs_sts[i_name] = "listening" if vlan_table[i_name] != 'T' \
-            else "blocking"
+    # The names are resolved here once, everything after this point
+    # addresses the interfaces through the port table
+    ports = build_port_table(num_intrfs, vlan_table, options['lags'])
 
-    stp = {
-        'own_brd_id': sw_priority,
-        'root_brd_id': sw_priority,
-        'root_pth_cost': 0,
-        'root_intrf': -1
-    }
+    if options['pvst']:
+        tree = PVST
+    else:
+        tree = RSTP if options['rstp'] else STP
+    # all the timed work of the control plane runs on a single timer wheel
+    wheel = TimerWheel(STP_TICK, time.monotonic())
+    stp = tree(ports, sw_priority, get_switch_mac(), options, wheel)
+    storm = StormControl(ports, options, wheel) \
+        if options['storm-control'] else None
+    snooping = Snooping(ports, options, wheel) \
+        if options['igmp-snooping'] else None
 
-    # Create and start a new thread that deals with sending BPDU
-    t = threading.Thread(target=send_bpdu_every_sec, 
-                         args=(stp, intrfs, vlan_table))
-    t.start()
+    if options['workers']:
+        run_workers(ports, stp, wheel, options,
+                    min(options['workers'], num_intrfs), storm, snooping)
+        return
 
-    while True:
-        # data is of type bytes([...]).
-        recv_intrf, data, length = recv_from_any_link()
-        dest_mac, src_mac, ethertype, vlan_id = parse_ethernet_header(data)
+    # the asyncio mode runs the stp on the loop, it needs no thread
+    if options['asyncio']:
+        switch = Switch(ports, stp, options, storm=storm, snooping=snooping)
+        dump_state(switch.fdb, stp, storm, snooping, switch.arp)
+        switch.run_async(options['batch'] or MAX_BATCH, wheel)
+        return
 
-        # human readable format for dest and src macs
-        dest_mac = ':'.join(f'{b:02x}' for b in dest_mac)
-        src_mac = ':'.join(f'{b:02x}' for b in src_mac)
+    # The control plane runs in its own thread, the data path hands it the
+    # BPDUs and the IGMP messages through a pipe
+    control_read, control_write = os.pipe()
+    os.set_blocking(control_write, False)
+    switch = Switch(ports, stp, options, control_pipe=control_write,
+                    storm=storm)
 
-        mac_table[src_mac] = recv_intrf
+    dump_state(switch.fdb, stp, storm, snooping, switch.arp)
 
-        if is_unicast(dest_mac):
-            if dest_mac in mac_table:
-                forward_frame(mac_table[dest_mac], length, data, vlan_id,
-                              vlan_table, recv_intrf, intrfs_sts)
+    t = threading.Thread(target=run_control,
+                         args=(stp, wheel, control_read, switch.publish, None,
+                               snooping, switch.publish_groups))
+    t.start()
 
-            else:
-                for i in intrfs:
-                    if i != recv_intrf:
-                        forward_frame(i, length, data, vlan_id, vlan_table, 
-                                      recv_intrf, intrfs_sts)
-
-        elif is_bpdu(dest_mac):
-            parse_bpdu_frame(data, recv_intrf, stp, intrfs, intrfs_sts,
-                             vlan_table)
-
-        else: # is broadcast
-            for i in intrfs:
-                if i != recv_intrf:
-                    forward_frame(i, length, data, vlan_id, vlan_table,
-                                  recv_intrf, intrfs_sts)
+    # the ring mode falls back to the sockets when it is not available
+    if wrapper.get_io_mode() == IO_RING:
+        switch.run_ring()
+    elif options['batch']:
+        switch.run_batch(options['batch'])
+    else:
+        switch.run()
 
 if __name__ == "__main__":
     main()
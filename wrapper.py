@@ -1,4 +1,5 @@
 import ctypes
+import struct
 import sys
 from ctypes import create_string_buffer
 
@@ -13,21 +14,109 @@ lib = ctypes.CDLL('./dlink.so')
 lib.recv_from_any_link.argtypes = (ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t))
 lib.recv_from_any_link.restype = ctypes.c_int
 
+lib.recv_batch.argtypes = (ctypes.c_char_p, ctypes.c_size_t,
+                           ctypes.POINTER(ctypes.c_int),
+                           ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.recv_batch.restype = ctypes.c_int
+
+lib.recv_link_batch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t,
+                                ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.recv_link_batch.restype = ctypes.c_int
+
+lib.get_interface_fd.argtypes = (ctypes.c_int,)
+lib.get_interface_fd.restype = ctypes.c_int
+
 lib.send_to_link.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t)
 lib.send_to_link.restype = ctypes.c_int
 
+lib.send_to_many.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+                             ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+                             ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int,
+                             ctypes.c_char_p)
+lib.send_to_many.restype = ctypes.c_int
+
 lib.init.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p))
 lib.init.restype = ctypes.c_int
 
+lib.init_mode.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p),
+                          ctypes.c_int)
+lib.init_mode.restype = ctypes.c_int
+
+lib.get_io_mode.argtypes = ()
+lib.get_io_mode.restype = ctypes.c_int
+
+lib.ring_next_block.argtypes = (ctypes.POINTER(ctypes.c_size_t),)
+lib.ring_next_block.restype = ctypes.c_int
+
+lib.ring_release_block.argtypes = (ctypes.c_int,)
+lib.ring_release_block.restype = None
+
+lib.ring_rx_map.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_size_t))
+lib.ring_rx_map.restype = ctypes.c_void_p
+
+lib.ring_defer_tx.argtypes = (ctypes.c_int,)
+lib.ring_defer_tx.restype = None
+
+lib.ring_flush.argtypes = ()
+lib.ring_flush.restype = None
+
+lib.init_worker.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+lib.init_worker.restype = None
+
+lib.fdb_create.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_uint,
+                           ctypes.c_uint, ctypes.c_uint)
+lib.fdb_create.restype = None
+
+lib.fdb_learn.argtypes = (ctypes.c_uint64, ctypes.c_int, ctypes.c_uint)
+lib.fdb_learn.restype = None
+
+lib.fdb_lookup.argtypes = (ctypes.c_uint64,)
+lib.fdb_lookup.restype = ctypes.c_int
+
+lib.fdb_expire.argtypes = (ctypes.c_uint, ctypes.c_uint)
+lib.fdb_expire.restype = ctypes.c_int
+
+lib.fdb_flush.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+                          ctypes.c_int)
+lib.fdb_flush.restype = ctypes.c_int
+
+lib.fdb_count.argtypes = ()
+lib.fdb_count.restype = ctypes.c_int
+
+lib.fdb_entries.argtypes = (ctypes.POINTER(ctypes.c_uint64),
+                            ctypes.POINTER(ctypes.c_int),
+                            ctypes.POINTER(ctypes.c_uint),
+                            ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+                            ctypes.c_uint)
+lib.fdb_entries.restype = ctypes.c_int
+
 lib.get_interface_mac.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_uint8))
 lib.get_interface_mac.restype = None
 
+lib.link_up.argtypes = (ctypes.c_int,)
+lib.link_up.restype = ctypes.c_int
+
+lib.set_link_up.argtypes = (ctypes.c_int, ctypes.c_int)
+lib.set_link_up.restype = ctypes.c_int
+
+lib.link_events_open.argtypes = ()
+lib.link_events_open.restype = ctypes.c_int
+
+lib.read_link_events.argtypes = ()
+lib.read_link_events.restype = ctypes.c_int
+
+lib.link_speed.argtypes = (ctypes.c_int,)
+lib.link_speed.restype = ctypes.c_int
+
 lib.get_interface_name.argtypes = [ctypes.c_int]
 lib.get_interface_name.restype = ctypes.c_char_p
 
 # Peste functiile de mai sus, definim urmatoarele functii in python pe care
 # urmeaza sa le folosim implementarea noastra
-def init(argv_p):
+IO_SOCKET = 0
+IO_RING = 1
+
+def init(argv_p, io_mode=IO_SOCKET):
     # Get the command-line arguments using sys.argv
     print("Initializing the switch")
     argv = [arg.encode('utf-8') for arg in argv_p]  # Convert each argument to bytes
@@ -36,34 +125,154 @@ def init(argv_p):
     argc = len(argv)
     argv_array = (ctypes.c_char_p * argc)(*argv)
     # Call the hub init function
-    num_int = lib.init(argc, argv_array)
+    num_int = lib.init_mode(argc, argv_array, io_mode)
+
+    if lib.get_io_mode() == IO_RING:
+        map_rings(num_int)
+
     return num_int
 
+# Returns the I/O mode in use, IO_RING only if the rings could be set up
+def get_io_mode():
+    return lib.get_io_mode()
+
+# In a worker process forked after init, only the interfaces in rx_ports are
+# received from. Sending still works on all of them
+def init_worker(rx_ports):
+    lib.init_worker(port_array(rx_ports), len(rx_ports))
+
+MAX_PACKET_LEN = 1600
+MAX_BATCH = 64
+
+# Every receive buffer keeps HEADROOM free bytes in front of the frame, so a
+# vlan tag can be inserted in place by moving the macs back into it
+HEADROOM = 4
+BUFFER_LEN = HEADROOM + MAX_PACKET_LEN
+
+# The pool of receive buffers, allocated once. Buffer i is exposed as the
+# memoryview buffers[i] and the frame received in it starts at HEADROOM
+pool = ctypes.create_string_buffer(MAX_BATCH * BUFFER_LEN)
+pool_view = memoryview(pool).cast('B')
+buffers = [pool_view[i * BUFFER_LEN:(i + 1) * BUFFER_LEN]
+           for i in range(MAX_BATCH)]
+rx_frame = (ctypes.c_char * MAX_PACKET_LEN).from_buffer(pool, HEADROOM)
+rx_length = ctypes.c_size_t()
+
+batch_ports = (ctypes.c_int * MAX_BATCH)()
+batch_lengths = (ctypes.c_size_t * MAX_BATCH)()
+
+# Returns (interface, buffer, length). The frame is received in the first pool
+# buffer at HEADROOM, no copies are made, so it is only valid until the next
+# receive call. interface is -1 if the wait was interrupted by a signal
 def recv_from_any_link():
-    # Create a buffer for the data to be written into
-    buffer_size = 1600 # MAX_PACKET_LEN
+    result = lib.recv_from_any_link(rx_frame, ctypes.byref(rx_length))
 
-    buffer = ctypes.create_string_buffer(buffer_size)
-    # Create a ctypes variable for the length
-    length = ctypes.c_size_t()
+    return result, buffers[0], rx_length.value
 
-    # Call the C function
-    result = lib.recv_from_any_link(buffer, ctypes.byref(length))
+# Returns a list of (interface, buffer, length) with up to max_frames frames,
+# each one in its own pool buffer at HEADROOM, valid until the next receive
+# call
+def recv_batch(max_frames):
+    count = lib.recv_batch(rx_frame, BUFFER_LEN, batch_ports, batch_lengths,
+                           min(max_frames, MAX_BATCH))
+
+    return [(batch_ports[i], buffers[i], batch_lengths[i])
+            for i in range(count)]
 
-    return result, bytes(buffer.raw[:length.value]), length.value
+# Same as recv_batch for a single interface, without blocking: the frames
+# already queued on it, none if there are not any
+def recv_link_batch(interface, max_frames):
+    count = lib.recv_link_batch(interface, rx_frame, BUFFER_LEN, batch_lengths,
+                                min(max_frames, MAX_BATCH))
 
-# Receives an interface, a byte array and a length.
+    return [(interface, buffers[i], batch_lengths[i]) for i in range(count)]
+
+# The file descriptor of an interface, for an event loop to wait on
+def get_interface_fd(interface):
+    return lib.get_interface_fd(interface)
+
+def c_frame(length, buffer):
+    # bytes are passed as they are, for the pool memoryviews a ctypes array
+    # is laid over the same memory, so the frame is never copied
+    if buffer is None or isinstance(buffer, bytes):
+        return buffer
+    return (ctypes.c_char * length).from_buffer(buffer)
+
+# Receives an interface, a byte array (or a pool memoryview) and a length.
 def send_to_link(interface, length, buffer):
-    # Create a buffer for the data to be written into
-    buffer_size = length
     # Make sure buffer is smaller than MAX_PACKET_LEN
-    assert(buffer_size < 1600)
-    
-    c_buf = create_string_buffer(buffer)
-    c_len = ctypes.c_size_t(buffer_size)
+    assert(length < MAX_PACKET_LEN)
 
     # Call the C function
-    result = lib.send_to_link(interface, c_buf, c_len)
+    result = lib.send_to_link(interface, c_frame(length, buffer), length)
+
+# The RX ring of every interface, as a memoryview over the shared memory
+ring_views = []
+ring_offset = ctypes.c_size_t()
+
+# tp_next_offset, tp_snaplen and tp_mac of a struct tpacket3_hdr
+RING_FRAME = struct.Struct("=I8xI8xH")
+# num_pkts and offset_to_first_pkt of a struct tpacket_block_desc
+RING_BLOCK = struct.Struct("=12xII")
+
+def map_rings(num_int):
+    size = ctypes.c_size_t()
+    for i in range(num_int):
+        addr = lib.ring_rx_map(i, ctypes.byref(size))
+        ring = (ctypes.c_char * size.value).from_address(addr)
+        ring_views.append(memoryview(ring).cast('B'))
+
+# IO_RING only. Returns (interface, frames) for the next block of received
+# frames, frames being (interface, buffer, length) tuples like recv_batch.
+# The frames are walked in the ring memory, there are no syscalls per frame
+# and no copies; the kernel leaves HEADROOM free bytes in front of each frame
+# (PACKET_RESERVE), so buffer is laid out like a pool buffer. They are valid
+# until release_block(interface). interface is -1 if interrupted by a signal
+def recv_block():
+    port = lib.ring_next_block(ctypes.byref(ring_offset))
+    if port < 0:
+        return port, []
+
+    view = ring_views[port]
+    block = ring_offset.value
+    num_pkts, offset = RING_BLOCK.unpack_from(view, block)
+
+    frames = []
+    offset += block
+    for _ in range(num_pkts):
+        next_offset, length, mac = RING_FRAME.unpack_from(view, offset)
+        start = offset + mac - HEADROOM
+        frames.append((port, view[start:start + HEADROOM + length], length))
+        offset += next_offset
+
+    return port, frames
+
+# Hands the block returned by recv_block back to the kernel
+def release_block(port):
+    lib.ring_release_block(port)
+
+# While on, the frames sent by the calling thread are only queued in the TX
+# rings, until flush_tx
+def defer_tx(on):
+    lib.ring_defer_tx(int(on))
+
+def flush_tx():
+    lib.ring_flush()
+
+# Converts a list of interfaces to the array send_to_many expects. Lists that
+# are reused (e.g. the flood lists) should be converted once
+def port_array(ports):
+    return (ctypes.c_int * len(ports))(*ports)
+
+# Sends buffer, the frame as received, untagged on every interface in
+# untagged and tagged on every one in tagged with a single call into dlink,
+# which adds (the 4 bytes of tag) or removes the vlan tag itself for the ports
+# that need it. untagged and tagged are port_array results
+def send_to_many(untagged, tagged, length, buffer, is_tagged, tag):
+    assert(length + 4 < MAX_PACKET_LEN)
+
+    lib.send_to_many(untagged, len(untagged), tagged, len(tagged),
+                     c_frame(length, buffer), length, int(is_tagged), tag)
 
 def get_switch_mac():
     # Create a buffer for the MAC address
@@ -76,7 +285,54 @@ def get_switch_mac():
     
     return bytes(mac_buffer)
 
+# True if the interface is up and has carrier
+def link_up(interface):
+    return lib.link_up(interface) != 0
+
+# Sets the interface up or down, False if it could not be done
+def set_link_up(interface, up):
+    return lib.set_link_up(interface, int(up)) == 0
+
+# The fd of a netlink socket that is readable when a link changes, None if
+# it can not be opened, then the changes are only seen by polling link_up
+def link_events_open():
+    fd = lib.link_events_open()
+    return fd if fd >= 0 else None
+
+# Drains the link changes, returns how many concern the switch interfaces
+read_link_events = lib.read_link_events
+
+# The speed of the interface in Mb/s, None if the driver does not report it
+def link_speed(interface):
+    speed = lib.link_speed(interface)
+    return speed if speed > 0 else None
+
 # Returns the name of an interface, used for the VLAN subtask
 def get_interface_name(interface):
 
     return lib.get_interface_name(interface).decode('utf-8')
+
+# The shared FDB of the multi-process mode (lib/fdb.c). fdb_create must be
+# called before the workers are forked. Keys are vlan << 48 | mac
+fdb_create = lib.fdb_create
+fdb_learn = lib.fdb_learn
+fdb_lookup = lib.fdb_lookup
+fdb_expire = lib.fdb_expire
+fdb_count = lib.fdb_count
+
+# Removes the entries on one of ports, only in vlan if it is not None
+def fdb_flush(ports, vlan=None):
+    return lib.fdb_flush(port_array(ports), len(ports),
+                         -1 if vlan is None else vlan)
+
+# Returns a list of (key, port, stamp, frozen) with all the entries
+def fdb_entries(now):
+    count = lib.fdb_count()
+    keys = (ctypes.c_uint64 * count)()
+    ports = (ctypes.c_int * count)()
+    stamps = (ctypes.c_uint * count)()
+    frozen = (ctypes.c_int * count)()
+    count = lib.fdb_entries(keys, ports, stamps, frozen, count, now)
+
+    return [(keys[i], ports[i], stamps[i], bool(frozen[i]))
+            for i in range(count)]